@@ -10,6 +10,7 @@ Lovisa.Lugnegaard@cern.ch, CERN/IT-ST
 
 import time
 import http
+import tempfile
 from base64 import urlsafe_b64encode
 import requests
 import grpc
@@ -42,17 +43,17 @@ def authenticate_for_test(userid, userpwd):
   '''Use basic authentication against Reva for testing purposes'''
   authReq = cs3gw.AuthenticateRequest(type='basic', client_id=userid, client_secret=userpwd)
   authRes = ctx['cs3stub'].Authenticate(authReq)
-  ctx['log'].debug('msg="Authenticated user" res="%s"' % authRes)
+  ctx['log'].debug('msg="Authenticated user" res="%s"', authRes)
   if authRes.status.code != cs3code.CODE_OK:
     raise IOError('Failed to authenticate as user ' + userid + ': ' + authRes.status.message)
   return authRes.token
 
 
-def stat(endpoint, fileid, userid, versioninv=0):
+def stat(endpoint, fileid, userid, versioninv=0, nocache=False):    # pylint: disable=unused-argument
   '''Stat a file and returns (size, mtime) as well as other extended info using the given userid as access token.
   Note that endpoint here means the storage id. Note that fileid can be either a path (which MUST begin with /),
   or an id (which MUST NOT start with a /).
-  The versioninv flag is currently not supported, see CERNBOX-1216.'''
+  The versioninv flag is currently not supported, see CERNBOX-1216. The nocache flag is ignored as nothing is cached here.'''
   if endpoint == 'default':
     raise IOError('A CS3API-compatible storage endpoint must be identified by a storage UUID')
   if versioninv == 1:
@@ -67,15 +68,15 @@ def stat(endpoint, fileid, userid, versioninv=0):
   statInfo = ctx['cs3stub'].Stat(request=cs3sp.StatRequest(ref=ref),
                                  metadata=[('x-access-token', userid)])
   tend = time.time()
-  ctx['log'].info('msg="Invoked stat" fileid="%s" elapsedTimems="%.1f"' % (fileid, (tend-tstart)*1000))
+  ctx['log'].info('msg="Invoked stat" fileid="%s" elapsedTimems="%.1f"', fileid, (tend-tstart)*1000)
   if statInfo.status.code == cs3code.CODE_OK:
-    ctx['log'].debug('msg="Stat result" data="%s"' % statInfo)
+    ctx['log'].debug('msg="Stat result" data="%s"', statInfo)
     # we base64-encode the inode so it can be used in a WOPISrc
     inode = urlsafe_b64encode(statInfo.info.id.opaque_id.encode())
     if statInfo.info.type == cs3spr.RESOURCE_TYPE_CONTAINER:
       raise IOError('Is a directory')
     elif statInfo.info.type not in (cs3spr.RESOURCE_TYPE_FILE, cs3spr.RESOURCE_TYPE_SYMLINK):
-      ctx['log'].warning('msg="Stat: unexpected type" type="%d"' % statInfo.info.type)
+      ctx['log'].warning('msg="Stat: unexpected type" type="%d"', statInfo.info.type)
       raise IOError('Unexpected type %d' % statInfo.info.type)
     return {
         'inode': statInfo.info.id.storage_id + '-' + inode.decode(),
@@ -84,13 +85,13 @@ def stat(endpoint, fileid, userid, versioninv=0):
         'size': statInfo.info.size,
         'mtime': statInfo.info.mtime.seconds
         }
-  ctx['log'].info('msg="Failed stat" fileid="%s" reason="%s"' % (fileid, statInfo.status.message))
+  ctx['log'].info('msg="Failed stat" fileid="%s" reason="%s"', fileid, statInfo.status.message)
   raise IOError('No such file or directory' if statInfo.status.code == cs3code.CODE_NOT_FOUND else statInfo.status.message)
 
 
-def statx(endpoint, fileid, userid, versioninv=0):
+def statx(endpoint, fileid, userid, versioninv=0, nocache=False):
   '''Get extended stat info (inode, filepath, userid, size, mtime). Equivalent to stat.'''
-  return stat(endpoint, fileid, userid, versioninv)
+  return stat(endpoint, fileid, userid, versioninv, nocache)
 
 
 def setxattr(_endpoint, filepath, userid, key, value):
@@ -102,29 +103,30 @@ def setxattr(_endpoint, filepath, userid, key, value):
   res = ctx['cs3stub'].SetArbitraryMetadata(request=req,
                                             metadata=[('x-access-token', userid)])
   if res.status.code != cs3code.CODE_OK:
-    ctx['log'].warning('msg="Failed to getxattr" filepath="%s" key="%s" reason="%s"' % (filepath, key, res.status.message))
+    ctx['log'].warning('msg="Failed to getxattr" filepath="%s" key="%s" reason="%s"', filepath, key, res.status.message)
     raise IOError(res.status.message)
-  ctx['log'].debug('msg="Invoked setxattr" result="%s"' % res)
+  ctx['log'].debug('msg="Invoked setxattr" result="%s"', res)
 
 
-def getxattr(_endpoint, filepath, userid, key):
-  '''Get the extended attribute <key> using the given userid as access token. Do not raise exceptions'''
+def getxattr(_endpoint, filepath, userid, key, nocache=False):    # pylint: disable=unused-argument
+  '''Get the extended attribute <key> using the given userid as access token. Do not raise exceptions.
+  The nocache flag is ignored as nothing is cached here.'''
   tstart = time.time()
   reference = cs3spr.Reference(path=filepath)
   statInfo = ctx['cs3stub'].Stat(request=cs3sp.StatRequest(ref=reference),
                                  metadata=[('x-access-token', userid)])
   tend = time.time()
   if statInfo.status.code != cs3code.CODE_OK:
-    ctx['log'].warning('msg="Failed to stat" filepath="%s" key="%s" reason="%s"' % (filepath, key, statInfo.status.message))
+    ctx['log'].warning('msg="Failed to stat" filepath="%s" key="%s" reason="%s"', filepath, key, statInfo.status.message)
     raise IOError(statInfo.status.message)
   try:
     xattrvalue = statInfo.info.arbitrary_metadata.metadata[key]
     if xattrvalue == '':
       raise KeyError
-    ctx['log'].debug('msg="Invoked stat for getxattr" filepath="%s" elapsedTimems="%.1f"' % (filepath, (tend-tstart)*1000))
+    ctx['log'].debug('msg="Invoked stat for getxattr" filepath="%s" elapsedTimems="%.1f"', filepath, (tend-tstart)*1000)
     return xattrvalue
   except KeyError:
-    ctx['log'].info('msg="Key not found in getxattr" filepath="%s" key="%s"' % (filepath, key))
+    ctx['log'].info('msg="Key not found in getxattr" filepath="%s" key="%s"', filepath, key)
     return None
 
 
@@ -134,25 +136,26 @@ def rmxattr(_endpoint, filepath, userid, key):
   req = cs3sp.UnsetArbitraryMetadataRequest(ref=reference, arbitrary_metadata_keys=[key])
   res = ctx['cs3stub'].UnsetArbitraryMetadata(request=req, metadata=[('x-access-token', userid)])
   if res.status.code != cs3code.CODE_OK:
-    ctx['log'].warning('msg="Failed to rmxattr" filepath="%s" key="%s" exception="%s"' % (filepath, key, res.status.message))
+    ctx['log'].warning('msg="Failed to rmxattr" filepath="%s" key="%s" exception="%s"', filepath, key, res.status.message)
     raise IOError(res.status.message)
-  ctx['log'].debug('msg="Invoked rmxattr" result="%s"' % res)
+  ctx['log'].debug('msg="Invoked rmxattr" result="%s"', res)
 
 
 def readfile(_endpoint, filepath, userid):
-  '''Read a file using the given userid as access token. Note that the function is a generator, managed by Flask.'''
+  '''Read a file using the given userid as access token. The file is downloaded upfront and IOError is raised
+     on failure, otherwise a generator of the file's chunks is returned, managed by Flask.'''
   tstart = time.time()
   # prepare endpoint
   req = cs3sp.InitiateFileDownloadRequest(ref=cs3spr.Reference(path=filepath))
   initfiledownloadres = ctx['cs3stub'].InitiateFileDownload(request=req, metadata=[('x-access-token', userid)])
   if initfiledownloadres.status.code == cs3code.CODE_NOT_FOUND:
-    ctx['log'].info('msg="File not found on read" filepath="%s"' % filepath)
-    yield IOError('No such file or directory')
-  elif initfiledownloadres.status.code != cs3code.CODE_OK:
-    ctx['log'].debug('msg="Failed to initiateFileDownload on read" filepath="%s" reason="%s"' % \
-                     (filepath, initfiledownloadres.status.message))
-    yield IOError(initfiledownloadres.status.message)
-  ctx['log'].debug('msg="readfile: InitiateFileDownloadRes returned" protocols="%s"' % initfiledownloadres.protocols)
+    ctx['log'].info('msg="File not found on read" filepath="%s"', filepath)
+    raise IOError('No such file or directory')
+  if initfiledownloadres.status.code != cs3code.CODE_OK:
+    ctx['log'].debug('msg="Failed to initiateFileDownload on read" filepath="%s" reason="%s"', \
+                     filepath, initfiledownloadres.status.message)
+    raise IOError(initfiledownloadres.status.message)
+  ctx['log'].debug('msg="readfile: InitiateFileDownloadRes returned" protocols="%s"', initfiledownloadres.protocols)
 
   # Download
   try:
@@ -163,39 +166,69 @@ def readfile(_endpoint, filepath, userid):
     }
     fileget = requests.get(url=protocol.download_endpoint, headers=headers)
   except requests.exceptions.RequestException as e:
-    ctx['log'].error('msg="Exception when downloading file from Reva" reason="%s"' % e)
-    yield IOError(e)
+    ctx['log'].error('msg="Exception when downloading file from Reva" reason="%s"', e)
+    raise IOError(e)
   tend = time.time()
-  data = fileget.content
   if fileget.status_code != http.client.OK:
-    ctx['log'].error('msg="Error downloading file from Reva" code="%d" reason="%s"' % (fileget.status_code, fileget.reason))
-    yield IOError(fileget.reason)
-  else:
-    ctx['log'].info('msg="File open for read" filepath="%s" elapsedTimems="%.1f"' % (filepath, (tend-tstart)*1000))
-    for i in range(0, len(data), ctx['chunksize']):
-      yield data[i:i+ctx['chunksize']]
+    ctx['log'].error('msg="Error downloading file from Reva" code="%d" reason="%s"', fileget.status_code, fileget.reason)
+    raise IOError(fileget.reason)
+  ctx['log'].info('msg="File open for read" filepath="%s" elapsedTimems="%.1f"', filepath, (tend-tstart)*1000)
+  data = fileget.content
+  return (data[i:i+ctx['chunksize']] for i in range(0, len(data), ctx['chunksize']))
 
 
 def writefile(_endpoint, filepath, userid, content, islock=False):
   '''Write a file using the given userid as access token. The entire content is written
     and any pre-existing file is deleted (or moved to the previous version if supported).
+    The content may be either a bytes/str buffer or a file-like object.
     The islock flag is currently not supported. TODO the backend should at least support
     writing the file with O_CREAT|O_EXCL flags to prevent races.'''
   if islock:
     ctx['log'].warning('msg="Lock (no-overwrite) flag not yet supported, going for standard upload"')
   tstart = time.time()
+  if hasattr(content, 'read'):
+    # the Upload-Length must be known upfront, therefore streams are fully received here, spooling
+    # to local disk beyond the configured chunksize, and then uploaded from the spool
+    content, size = _spoolstream(filepath, content)
+  else:
+    if isinstance(content, str):
+      content = bytes(content, 'UTF-8')
+    size = len(content)
+  try:
+    _uploadcontent(filepath, userid, content, str(size), islock, tstart)
+  finally:
+    if hasattr(content, 'read'):
+      content.close()
+
+
+def _spoolstream(filepath, content):
+  '''Receive the whole content of the given file-like object into a temporary file, kept in memory up to
+     the configured chunksize and on local disk beyond, and return it rewound together with its size.
+     IOError is raised if the stream fails midway.'''
+  spool = tempfile.SpooledTemporaryFile(max_size=ctx['chunksize'])
+  try:
+    for chunk in iter(lambda: content.read(ctx['chunksize']), b''):
+      spool.write(chunk)
+  except Exception as e:     # pylint: disable=broad-except
+    spool.close()
+    ctx['log'].warning('msg="Error receiving the content to write" filepath="%s" error="%s"', filepath, e)
+    raise IOError(e)
+  size = spool.tell()
+  spool.seek(0)
+  return spool, size
+
+
+def _uploadcontent(filepath, userid, content, size, islock, tstart):
+  '''Upload the given content of the given size (either a bytes buffer or a file-like object) to Reva'''
   # prepare endpoint
-  if isinstance(content, str):
-    content = bytes(content, 'UTF-8')
-  size = str(len(content))
   metadata = types.Opaque(map={"Upload-Length": types.OpaqueEntry(decoder="plain", value=str.encode(size))})
   req = cs3sp.InitiateFileUploadRequest(ref=cs3spr.Reference(path=filepath), opaque=metadata)
   initfileuploadres = ctx['cs3stub'].InitiateFileUpload(request=req, metadata=[('x-access-token', userid)])
   if initfileuploadres.status.code != cs3code.CODE_OK:
-    ctx['log'].debug('msg="Failed to initiateFileUpload on write" filepath="%s" reason="%s"' % \
-                     (filepath, initfileuploadres.status.message))
+    ctx['log'].debug('msg="Failed to initiateFileUpload on write" filepath="%s" reason="%s"', \
+                     filepath, initfileuploadres.status.message)
     raise IOError(initfileuploadres.status.message)
-  ctx['log'].debug('msg="writefile: InitiateFileUploadRes returned" protocols="%s"' % initfileuploadres.protocols)
+  ctx['log'].debug('msg="writefile: InitiateFileUploadRes returned" protocols="%s"', initfileuploadres.protocols)
 
   # Upload
   try:
@@ -209,14 +242,14 @@ def writefile(_endpoint, filepath, userid, content, islock=False):
     }
     putres = requests.put(url=protocol.upload_endpoint, data=content, headers=headers)
   except requests.exceptions.RequestException as e:
-    ctx['log'].error('msg="Exception when uploading file to Reva" reason="%s"' % e)
+    ctx['log'].error('msg="Exception when uploading file to Reva" reason="%s"', e)
     raise IOError(e)
   tend = time.time()
   if putres.status_code != http.client.OK:
-    ctx['log'].error('msg="Error uploading file to Reva" code="%d" reason="%s"' % (putres.status_code, putres.reason))
+    ctx['log'].error('msg="Error uploading file to Reva" code="%d" reason="%s"', putres.status_code, putres.reason)
     raise IOError(putres.reason)
-  ctx['log'].info('msg="File written successfully" filepath="%s" elapsedTimems="%.1f" islock="%s"' % \
-                  (filepath, (tend-tstart)*1000, islock))
+  ctx['log'].info('msg="File written successfully" filepath="%s" elapsedTimems="%.1f" islock="%s"', \
+                  filepath, (tend-tstart)*1000, islock)
 
 
 def renamefile(_endpoint, filepath, newfilepath, userid):
@@ -226,9 +259,9 @@ def renamefile(_endpoint, filepath, newfilepath, userid):
   req = cs3sp.MoveRequest(source=source, destination=destination)
   res = ctx['cs3stub'].Move(request=req, metadata=[('x-access-token', userid)])
   if res.status.code != cs3code.CODE_OK:
-    ctx['log'].warning('msg="Failed to rename file" filepath="%s" error="%s"' % (filepath, res.status.message))
+    ctx['log'].warning('msg="Failed to rename file" filepath="%s" error="%s"', filepath, res.status.message)
     raise IOError(res.status.message)
-  ctx['log'].debug('msg="Invoked renamefile" result="%s"' % res)
+  ctx['log'].debug('msg="Invoked renamefile" result="%s"', res)
 
 
 def removefile(_endpoint, filepath, userid, _force=0):
@@ -238,6 +271,6 @@ def removefile(_endpoint, filepath, userid, _force=0):
   req = cs3sp.DeleteRequest(ref=reference)
   res = ctx['cs3stub'].Delete(request=req, metadata=[('x-access-token', userid)])
   if res.status.code != cs3code.CODE_OK:
-    ctx['log'].warning('msg="Failed to remove file" filepath="%s" error="%s"' % (filepath, res))
+    ctx['log'].warning('msg="Failed to remove file" filepath="%s" error="%s"', filepath, res)
     raise IOError(res.status.message)
-  ctx['log'].debug('msg="Invoked removefile" result="%s"' % res)
+  ctx['log'].debug('msg="Invoked removefile" result="%s"', res)
@@ -8,6 +8,7 @@ Author: Giuseppe.LoPresti@cern.ch, CERN/IT-ST
 
 import time
 import os
+import tempfile
 import warnings
 from stat import S_ISDIR
 
@@ -15,6 +16,7 @@ from stat import S_ISDIR
 config = None
 log = None
 homepath = None
+chunksize = None
 
 
 def _getfilepath(filepath):
@@ -27,9 +29,11 @@ def init(inconfig, inlog):
   global config         # pylint: disable=global-statement
   global log            # pylint: disable=global-statement
   global homepath       # pylint: disable=global-statement
+  global chunksize      # pylint: disable=global-statement
   config = inconfig
   log = inlog
   homepath = config.get('local', 'storagehomepath')
+  chunksize = config.getint('io', 'chunksize')
   try:
     # validate the given storagehomepath folder
     mode = os.stat(homepath).st_mode
@@ -39,13 +43,14 @@ def init(inconfig, inlog):
     raise IOError('Could not stat storagehomepath folder %s: %s' % (homepath, e))
 
 
-def stat(_endpoint, filepath, _userid):
-  '''Stat a file and returns (size, mtime) as well as other extended info. This method assumes that the given userid has access.'''
+def stat(_endpoint, filepath, _userid, nocache=False):    # pylint: disable=unused-argument
+  '''Stat a file and returns (size, mtime) as well as other extended info. This method assumes that the given userid has access.
+  The nocache flag is ignored as nothing is cached here.'''
   try:
     tstart = time.time()
     statInfo = os.stat(_getfilepath(filepath))
     tend = time.time()
-    log.info('msg="Invoked stat" filepath="%s" elapsedTimems="%.1f"' % (_getfilepath(filepath), (tend-tstart)*1000))
+    log.info('msg="Invoked stat" filepath="%s" elapsedTimems="%.1f"', _getfilepath(filepath), (tend-tstart)*1000)
     if S_ISDIR(statInfo.st_mode):
       raise IOError('Is a directory')
     return {
@@ -59,10 +64,10 @@ def stat(_endpoint, filepath, _userid):
     raise IOError(e)
 
 
-def statx(endpoint, filepath, userid, versioninv=1):    # pylint: disable=unused-argument
+def statx(endpoint, filepath, userid, versioninv=1, nocache=False):    # pylint: disable=unused-argument
   '''Get extended stat info (inode, filepath, userid, size, mtime). Equivalent to stat in the case of local storage.
   The versioninv flag is ignored as local storage always supports version-invariant inodes (cf. CERNBOX-1216).'''
-  return stat(endpoint, filepath, userid)
+  return stat(endpoint, filepath, userid, nocache)
 
 
 def setxattr(_endpoint, filepath, _userid, key, value):
@@ -70,17 +75,18 @@ def setxattr(_endpoint, filepath, _userid, key, value):
   try:
     os.setxattr(_getfilepath(filepath), 'user.' + key, str(value).encode())
   except (FileNotFoundError, PermissionError, OSError) as e:
-    log.warning('msg="Failed to setxattr" filepath="%s" key="%s" exception="%s"' % (filepath, key, e))
+    log.warning('msg="Failed to setxattr" filepath="%s" key="%s" exception="%s"', filepath, key, e)
     raise IOError(e)
 
 
-def getxattr(_endpoint, filepath, _userid, key):
-  '''Get the extended attribute <key> on behalf of the given userid. Do not raise exceptions'''
+def getxattr(_endpoint, filepath, _userid, key, nocache=False):    # pylint: disable=unused-argument
+  '''Get the extended attribute <key> on behalf of the given userid. Do not raise exceptions.
+  The nocache flag is ignored as nothing is cached here.'''
   try:
     filepath = _getfilepath(filepath)
     return os.getxattr(filepath, 'user.' + key).decode('UTF-8')
   except (FileNotFoundError, PermissionError, OSError) as e:
-    log.warning('msg="Failed to getxattr" filepath="%s" key="%s" exception="%s"' % (filepath, key, e))
+    log.warning('msg="Failed to getxattr" filepath="%s" key="%s" exception="%s"', filepath, key, e)
     return None
 
 
@@ -89,43 +95,76 @@ def rmxattr(_endpoint, filepath, _userid, key):
   try:
     os.removexattr(_getfilepath(filepath), 'user.' + key)
   except (FileNotFoundError, PermissionError, OSError) as e:
-    log.warning('msg="Failed to rmxattr" filepath="%s" key="%s" exception="%s"' % (filepath, key, e))
+    log.warning('msg="Failed to rmxattr" filepath="%s" key="%s" exception="%s"', filepath, key, e)
     raise IOError(e)
 
 
 def readfile(_endpoint, filepath, _userid):
-  '''Read a file on behalf of the given userid. Note that the function is a generator, managed by Flask.'''
-  log.debug('msg="Invoking readFile" filepath="%s"' % filepath)
+  '''Read a file on behalf of the given userid. The file is opened upfront and IOError is raised on failure,
+     otherwise a generator of the file's chunks is returned, managed by Flask.'''
+  log.debug('msg="Invoking readFile" filepath="%s"', filepath)
+  tstart = time.time()
+  filepath = _getfilepath(filepath)
   try:
-    tstart = time.time()
-    filepath = _getfilepath(filepath)
-    chunksize = config.getint('io', 'chunksize')
-    with open(filepath, mode='rb', buffering=chunksize) as f:
-      tend = time.time()
-      log.info('msg="File open for read" filepath="%s" elapsedTimems="%.1f"' % (filepath, (tend-tstart)*1000))
-      # the actual read is buffered and managed by the Flask server
-      for chunk in iter(lambda: f.read(chunksize), b''):
-        yield chunk
-  except FileNotFoundError as e:
+    f = open(filepath, mode='rb', buffering=chunksize)
+  except FileNotFoundError:
     # log this case as info to keep the logs cleaner
-    log.info('msg="File not found on read" filepath="%s"' % filepath)
-    # as this is a generator, we yield the error string instead of the file's contents
-    yield IOError('No such file or directory')
+    log.info('msg="File not found on read" filepath="%s"', filepath)
+    raise IOError('No such file or directory')
   except OSError as e:
     # general case, issue a warning
-    log.warning('msg="Error opening the file for read" filepath="%s" error="%s"' % (filepath, e))
-    yield IOError(e)
+    log.warning('msg="Error opening the file for read" filepath="%s" error="%s"', filepath, e)
+    raise IOError(e)
+  tend = time.time()
+  log.info('msg="File open for read" filepath="%s" elapsedTimems="%.1f"', filepath, (tend-tstart)*1000)
+  return _readchunks(f)
+
+
+def _readchunks(f):
+  '''Yield the content of the open file f in chunks, and close it at the end'''
+  with f:
+    # the actual read is buffered and managed by the Flask server
+    for chunk in iter(lambda: f.read(chunksize), b''):
+      yield chunk
+
+
+def _writecontent(f, content):
+  '''Write the given content to the open file f, and return the number of written bytes.
+     If content is a file-like object, it is streamed in chunks of the configured size.'''
+  if not hasattr(content, 'read'):
+    return f.write(content)
+  written = 0
+  for chunk in iter(lambda: content.read(chunksize), b''):
+    written += f.write(chunk)
+  return written
+
+
+def _spoolstream(filepath, content):
+  '''Receive the whole content of the given file-like object into a temporary file, kept in memory up to
+     the configured chunksize and on local disk beyond, and return it rewound. IOError is raised if the stream
+     fails midway, e.g. on a client disconnection.'''
+  spool = tempfile.SpooledTemporaryFile(max_size=chunksize)
+  try:
+    for chunk in iter(lambda: content.read(chunksize), b''):
+      spool.write(chunk)
+  except Exception as e:     # pylint: disable=broad-except
+    spool.close()
+    log.warning('msg="Error receiving the content to write" filepath="%s" error="%s"', filepath, e)
+    raise IOError(e)
+  spool.seek(0)
+  return spool
 
 
 def writefile(_endpoint, filepath, _userid, content, islock=False):
   '''Write a file via xroot on behalf of the given userid. The entire content is written
      and any pre-existing file is deleted (or moved to the previous version if supported).
+     The content may be either a bytes/str buffer or a file-like object, which is then streamed.
      With islock=True, the file is opened with O_CREAT|O_EXCL.'''
   if isinstance(content, str):
     content = bytes(content, 'UTF-8')
-  size = len(content)
+  size = -1 if hasattr(content, 'read') else len(content)     # the size of a stream is not known upfront
   filepath = _getfilepath(filepath)
-  log.debug('msg="Invoking writeFile" filepath="%s" size="%d"' % (filepath, size))
+  log.debug('msg="Invoking writeFile" filepath="%s" size="%d"', filepath, size)
   tstart = time.time()
   if islock:
     warnings.simplefilter("ignore", ResourceWarning)
@@ -135,27 +174,34 @@ def writefile(_endpoint, filepath, _userid, content, islock=False):
       # so we resort to the os-level open(), with some caveats
       fd = os.open(filepath, os.O_CREAT | os.O_EXCL)
       f = os.fdopen(fd, mode='wb')
-      written = f.write(content)    # os.write(fd, ...) raises EBADF?
+      written = _writecontent(f, content)    # os.write(fd, ...) raises EBADF?
       os.close(fd)   # f.close() raises EBADF! while this works
       # as f goes out of scope here, we'd get a false ResourceWarning, which is ignored by the above filter
     except FileExistsError:
-      log.info('msg="File exists on write but islock flag requested" filepath="%s"' % filepath)
+      log.info('msg="File exists on write but islock flag requested" filepath="%s"', filepath)
       raise IOError('File exists and islock flag requested')
     except OSError as e:
-      log.warning('msg="Error writing file in O_EXCL mode" filepath="%s" error="%s"' % (filepath, e))
+      log.warning('msg="Error writing file in O_EXCL mode" filepath="%s" error="%s"', filepath, e)
       raise IOError(e)
   else:
+    if size < 0:
+      # the stream is fully received before the target is truncated, so that an aborted upload leaves it untouched;
+      # the target is then rewritten in place, which preserves its inode (used as fileid) and its xattrs
+      content = _spoolstream(filepath, content)
     try:
       with open(filepath, mode='wb') as f:
-        written = f.write(content)
+        written = _writecontent(f, content)
     except OSError as e:
-      log.warning('msg="Error writing file" filepath="%s" error="%s"' % (filepath, e))
+      log.warning('msg="Error writing file" filepath="%s" error="%s"', filepath, e)
       raise IOError(e)
+    finally:
+      if size < 0:
+        content.close()
   tend = time.time()
-  if written != size:
+  if size >= 0 and written != size:
     raise IOError('Written %d bytes but content is %d bytes' % (written, size))
-  log.info('msg="File written successfully" filepath="%s" elapsedTimems="%.1f" islock="%s"' % \
-           (filepath, (tend-tstart)*1000, islock))
+  log.info('msg="File written successfully" filepath="%s" elapsedTimems="%.1f" islock="%s"', \
+           filepath, (tend-tstart)*1000, islock)
 
 
 def renamefile(_endpoint, origfilepath, newfilepath, _userid):
@@ -21,6 +21,7 @@ import urllib.request
 import urllib.parse
 import http.client
 import json
+import threading
 import wopiutils as utils
 try:
   import flask                   # Flask app server
@@ -38,6 +39,19 @@ WOPISERVERVERSION = 'git'
 # alias of the storage layer module, see function below
 storage = None
 
+# the static index page, rendered once at startup (cf. Wopi.init)
+INDEXPAGE = """
+    <html><head><title>ScienceMesh WOPI Server</title></head>
+    <body>
+    <div align="center" style="color:#000080; padding-top:50px; font-family:Verdana; size:11">
+    This is the ScienceMesh IOP <a href=http://wopi.readthedocs.io>WOPI</a> server to support online office-like editors.<br>
+    To use this service, please log in to your EFSS Storage and click on a supported document.</div>
+    <div style="position: absolute; bottom: 10px; left: 10px; width: 99%%;"><hr>
+    <i>ScienceMesh WOPI Server %s at %s. Powered by Flask %s for Python %s</i>.
+    </body>
+    </html>
+    """
+
 def storage_layer_import(storagetype):
   '''A convenience function to import the storage layer module specified in the config and make it globally available'''
   global storage        # pylint: disable=global-statement
@@ -57,7 +71,6 @@ class Wopi:
   app = flask.Flask("WOPIServer")
   metrics = PrometheusMetrics(app, group_by='endpoint')
   port = 0
-  lastConfigReadTime = time.time()
   loglevels = {"Critical": logging.CRITICAL,  # 50
                "Error":    logging.ERROR,     # 40
                "Warning":  logging.WARNING,   # 30
@@ -75,6 +88,9 @@ class Wopi:
       hostname = os.environ.get('HOST_HOSTNAME')
       if not hostname:
         hostname = socket.gethostname()
+      # the fully qualified domain name is resolved once, it is not expected to change at runtime
+      cls.fqdn = socket.getfqdn()
+      cls.indexpage = (INDEXPAGE % (WOPISERVERVERSION, cls.fqdn, flask.__version__, python_version())).encode()
       # configure the logging
       loghandler = logging.FileHandler('/var/log/wopi/wopiserver.log')
       loghandler.setFormatter(logging.Formatter(
@@ -91,32 +107,40 @@ class Wopi:
       storage_layer_import(cls.config.get('general', 'storagetype'))
       # prepare the Flask web app
       cls.port = int(cls.config.get('general', 'port'))
-      cls.log.setLevel(cls.loglevels[cls.config.get('general', 'loglevel')])
+      cls.loglevel = cls.config.get('general', 'loglevel')
+      cls.log.setLevel(cls.loglevels[cls.loglevel])
       try:
-        cls.nonofficetypes = cls.config.get('general', 'nonofficetypes').split()
+        cls.nonofficetypes = frozenset(cls.config.get('general', 'nonofficetypes').split())
       except (TypeError, configparser.NoOptionError) as e:
-        cls.nonofficetypes = []
+        cls.nonofficetypes = frozenset()
       with open(cls.config.get('security', 'wopisecretfile')) as s:
-        cls.wopisecret = s.read().strip('\n')
+        # keep the secret as bytes, as this is the key material used to sign and verify all JWTs
+        cls.wopisecret = s.read().strip('\n').encode()
       with open(cls.config.get('security', 'iopsecretfile')) as s:
         cls.iopsecret = s.read().strip('\n')
+      # the expected Authorization header for the /wopi/iop and /wopi/cbox calls, computed once
+      cls.iopauthheader = 'Bearer ' + cls.iopsecret
       cls.tokenvalidity = cls.config.getint('general', 'tokenvalidity')
       storage.init(cls.config, cls.log)                          # initialize the storage layer
       cls.useHttps = cls.config.get('security', 'usehttps').lower() == 'yes'
       cls.repeatedLockRequests = {}               # cf. the wopiLock() function below
       cls.wopiurl = cls.config.get('general', 'wopiurl')
+      # the invariant part of any WOPISrc is URL-encoded once, cf. utils.generateWopiSrc()
+      cls.wopisrcprefix = urllib.parse.quote_plus(cls.wopiurl + '/wopi/files/')
       if cls.config.has_option('general', 'lockpath'):
         cls.lockpath = cls.config.get('general', 'lockpath')
       else:
         cls.lockpath = ''
-      _ = cls.config.get('general', 'downloadurl')   # make sure this is defined
+      cls.downloadurl = cls.config.get('general', 'downloadurl')
+      cls.webdavurl = cls.config.get('general', 'webdavurl', fallback=None)
+      cls.wopilockexpiration = cls.config.getint('general', 'wopilockexpiration')
       # initialize the utils module
       utils.wopi = cls
       utils.log = cls.log
       utils.st = storage
     except (configparser.NoOptionError, OSError) as e:
       # any error we get here with the configuration is fatal
-      cls.log.fatal('msg="Failed to initialize the service, aborting" error="%s"' % e)
+      cls.log.fatal('msg="Failed to initialize the service, aborting" error="%s"', e)
       sys.exit(-22)
 
   @classmethod
@@ -140,7 +164,7 @@ class Wopi:
       cls.ENDPOINTS['.pptx']['view'] = oos + '/p/PowerPointFrame.aspx?PowerPointView=ReadingView'
       cls.ENDPOINTS['.pptx']['edit'] = oos + '/p/PowerPointFrame.aspx?PowerPointView=EditView'
       cls.ENDPOINTS['.pptx']['new']  = oos + '/p/PowerPointFrame.aspx?PowerPointView=EditView&New=1'   # pylint: disable=bad-whitespace
-      cls.log.info('msg="Microsoft Office Online endpoints successfully configured" OfficeURL="%s"' % cls.ENDPOINTS['.docx']['edit'])
+      cls.log.info('msg="Microsoft Office Online endpoints successfully configured" OfficeURL="%s"', cls.ENDPOINTS['.docx']['edit'])
 
     code = cls.config.get('general', 'codeurl', fallback=None)
     if code:
@@ -160,11 +184,11 @@ class Wopi:
           cls.ENDPOINTS[t]['view'] = urlsrc + 'permission=readonly'
           cls.ENDPOINTS[t]['edit'] = urlsrc + 'permission=edit'
           cls.ENDPOINTS[t]['new']  = urlsrc + 'permission=edit'        # pylint: disable=bad-whitespace
-        cls.log.info('msg="Collabora Online endpoints successfully configured" count="%d" CODEURL="%s"' % \
-                     (len(codetypes), cls.ENDPOINTS['.odt']['edit']))
+        cls.log.info('msg="Collabora Online endpoints successfully configured" count="%d" CODEURL="%s"', \
+                     len(codetypes), cls.ENDPOINTS['.odt']['edit'])
 
       except (IOError, ET.ParseError) as e:
-        cls.log.warning('msg="Failed to initialize Collabora Online endpoints" error="%s"' % e)
+        cls.log.warning('msg="Failed to initialize Collabora Online endpoints" error="%s"', e)
 
     # The WOPI Bridge end-point
     bridge = cls.config.get('general', 'wopibridgeurl', fallback=None)
@@ -180,32 +204,97 @@ class Wopi:
     cls.ENDPOINTS['.zmd']['view'] = cls.ENDPOINTS['.zmd']['edit'] = bridge + '/open'
     cls.ENDPOINTS['.txt'] = {}
     cls.ENDPOINTS['.txt']['view'] = cls.ENDPOINTS['.txt']['edit'] = bridge + '/open'
-    cls.log.info('msg="WOPI Bridge endpoints successfully configured" BridgeURL="%s"' % bridge)
+    cls.log.info('msg="WOPI Bridge endpoints successfully configured" BridgeURL="%s"', bridge)
 
 
   @classmethod
   def refreshconfig(cls):
-    '''Re-read the configuration file every 300 secs to catch any runtime parameter change'''
-    if time.time() > cls.lastConfigReadTime + 300:
-      cls.lastConfigReadTime = time.time()
+    '''Re-read the configuration file to catch any runtime parameter change. This is executed
+    every 300 secs by a background timer, off the request path (cf. scheduleconfigrefresh)'''
+    try:
       cls.config.read('/etc/wopi/wopiserver.conf')
       # refresh some general parameters
       cls.tokenvalidity = cls.config.getint('general', 'tokenvalidity')
-      cls.log.setLevel(cls.loglevels[cls.config.get('general', 'loglevel')])
+      cls.downloadurl = cls.config.get('general', 'downloadurl')
+      cls.webdavurl = cls.config.get('general', 'webdavurl', fallback=None)
+      cls.wopilockexpiration = cls.config.getint('general', 'wopilockexpiration')
+      loglevel = cls.config.get('general', 'loglevel')
+      if loglevel != cls.loglevel:
+        # only apply the log level when it actually changed
+        cls.log.setLevel(cls.loglevels[loglevel])
+        cls.loglevel = loglevel
+    except (configparser.Error, ValueError, KeyError) as e:
+      cls.log.warning('msg="Failed to refresh the configuration, keeping the previous values" error="%s"', e)
+    finally:
+      cls.scheduleconfigrefresh()
+
+
+  @classmethod
+  def scheduleconfigrefresh(cls):
+    '''Schedule the next configuration refresh in a background (daemon) thread'''
+    timer = threading.Timer(300, cls.refreshconfig)
+    timer.daemon = True
+    timer.start()
+
+
+  @classmethod
+  def postfork(cls, _server, _worker):
+    '''Re-initializes the storage layer in the gunicorn worker process, as its connections
+    (e.g. the gRPC channel or the xroot clients) are not meant to be shared across a fork'''
+    storage.init(cls.config, cls.log)
+    # threads do not survive a fork, therefore the configuration refresh is scheduled here
+    cls.scheduleconfigrefresh()
+
+
+  @classmethod
+  def rungunicorn(cls, threads):
+    '''Runs the Flask app within gunicorn, using a single worker process with the given number of threads.
+    Multiple worker processes are not supported, as the WOPI server keeps some in-memory state.'''
+    try:
+      import gunicorn.app.base
+    except ImportError:
+      cls.log.fatal('msg="Missing gunicorn module, please install it or unset the gunicornthreads option"')
+      sys.exit(-22)
+
+    class WopiGunicornApp(gunicorn.app.base.BaseApplication):
+      '''A minimal gunicorn application embedding the WOPI Flask app'''
+      def load_config(self):
+        '''Configure gunicorn from the WOPI server settings'''
+        self.cfg.set('bind', '0.0.0.0:%d' % cls.port)
+        self.cfg.set('workers', 1)
+        self.cfg.set('worker_class', 'gthread')
+        self.cfg.set('threads', threads)
+        self.cfg.set('post_fork', cls.postfork)
+        if cls.useHttps:
+          self.cfg.set('certfile', cls.config.get('security', 'wopicert'))
+          self.cfg.set('keyfile', cls.config.get('security', 'wopikey'))
+
+      def load(self):
+        '''Return the WSGI application'''
+        return cls.app
+
+    WopiGunicornApp().run()
 
 
   @classmethod
   def run(cls):
-    '''Runs the Flask app in either standalone (https) or embedded (http) mode'''
+    '''Runs the Flask app in either standalone (https) or embedded (http) mode, within gunicorn if configured'''
+    threads = cls.config.getint('general', 'gunicornthreads', fallback=0)
+    if cls.useHttps:
+      cls.log.info('msg="WOPI Server starting in standalone secure mode" port="%d" wopiurl="%s" version="%s" ' \
+                   'gunicornthreads="%d"', cls.port, cls.wopiurl, WOPISERVERVERSION, threads)
+    else:
+      cls.log.info('msg="WOPI Server starting in unsecure/embedded mode" port="%d" wopiurl="%s" version="%s" ' \
+                   'gunicornthreads="%d"', cls.port, cls.wopiurl, WOPISERVERVERSION, threads)
+    if threads > 0:
+      cls.rungunicorn(threads)
+      return
+    cls.scheduleconfigrefresh()
     if cls.useHttps:
-      cls.log.info('msg="WOPI Server starting in standalone secure mode" port="%d" wopiurl="%s" version="%s"' % \
-                   (cls.port, cls.wopiurl, WOPISERVERVERSION))
-      cls.app.run(host='0.0.0.0', port=cls.port, threaded=True, debug=(cls.config.get('general', 'loglevel') == 'Debug'),
+      cls.app.run(host='0.0.0.0', port=cls.port, threaded=True, debug=(cls.loglevel == 'Debug'),
                   ssl_context=(cls.config.get('security', 'wopicert'), cls.config.get('security', 'wopikey')))
     else:
-      cls.log.info('msg="WOPI Server starting in unsecure/embedded mode" port="%d" wopiurl="%s" version="%s"' % \
-                   (cls.port, cls.wopiurl, WOPISERVERVERSION))
-      cls.app.run(host='0.0.0.0', port=cls.port, threaded=True, debug=(cls.config.get('general', 'loglevel') == 'Debug'))
+      cls.app.run(host='0.0.0.0', port=cls.port, threaded=True, debug=(cls.loglevel == 'Debug'))
 
 
 #
@@ -227,18 +316,8 @@ def redir():
 @Wopi.app.route("/wopi", methods=['GET'])
 def index():
   '''Return a default index page with some user-friendly information about this service'''
-  Wopi.log.debug('msg="Accessed index page" client="%s"' % flask.request.remote_addr)
-  return """
-    <html><head><title>ScienceMesh WOPI Server</title></head>
-    <body>
-    <div align="center" style="color:#000080; padding-top:50px; font-family:Verdana; size:11">
-    This is the ScienceMesh IOP <a href=http://wopi.readthedocs.io>WOPI</a> server to support online office-like editors.<br>
-    To use this service, please log in to your EFSS Storage and click on a supported document.</div>
-    <div style="position: absolute; bottom: 10px; left: 10px; width: 99%%;"><hr>
-    <i>ScienceMesh WOPI Server %s at %s. Powered by Flask %s for Python %s</i>.
-    </body>
-    </html>
-    """ % (WOPISERVERVERSION, socket.getfqdn(), flask.__version__, python_version())
+  Wopi.log.debug('msg="Accessed index page" client="%s"', flask.request.remote_addr)
+  return flask.Response(Wopi.indexpage, mimetype='text/html')
 
 
 @Wopi.app.route("/wopi/iop/open", methods=['GET'])
@@ -265,12 +344,11 @@ def iopOpen():
   - string endpoint (optional): the storage endpoint to be used to look up the file or the storage id, in case of
     multi-instance underlying storage; defaults to 'default'
   '''
-  Wopi.refreshconfig()
   req = flask.request
   # if running in https mode, first check if the shared secret matches ours
-  if req.headers.get('Authorization') != 'Bearer ' + Wopi.iopsecret:
+  if req.headers.get('Authorization') != Wopi.iopauthheader:
     Wopi.log.warning('msg="iopOpen: unauthorized access attempt, missing authorization token" ' \
-                     'client="%s" clientAuth="%s"' % (req.remote_addr, req.headers.get('Authorization')))
+                     'client="%s" clientAuth="%s"', req.remote_addr, req.headers.get('Authorization'))
     return 'Client not authorized', http.client.UNAUTHORIZED
   # now validate the user identity and deny root access
   try:
@@ -285,16 +363,16 @@ def iopOpen():
       if ruid == 0 or rgid == 0:
         raise ValueError
   except ValueError:
-    Wopi.log.warning('msg="iopOpen: invalid or missing user/token in request" client="%s" user="%s"' % \
-                     (req.remote_addr, userid))
+    Wopi.log.warning('msg="iopOpen: invalid or missing user/token in request" client="%s" user="%s"', \
+                     req.remote_addr, userid)
     return 'Client not authorized', http.client.UNAUTHORIZED
   fileid = urllib.parse.unquote(req.args['filename']) if 'filename' in req.args else req.args['fileid']
   if 'viewmode' in req.args:
     try:
       viewmode = utils.ViewMode(req.args['viewmode'])
     except ValueError:
-      Wopi.log.warning('msg="iopOpen: invalid viewmode parameter" client="%s" viewmode="%s"' % \
-                       (req.remote_addr, req.args['viewmode']))
+      Wopi.log.warning('msg="iopOpen: invalid viewmode parameter" client="%s" viewmode="%s"', \
+                       req.remote_addr, req.args['viewmode'])
       return 'Invalid argument', http.client.BAD_REQUEST
   else:
     # backwards compatibility
@@ -309,8 +387,8 @@ def iopOpen():
     return '%s&access_token=%s' % (utils.generateWopiSrc(inode), acctok)      # no need to URL-encode the JWT token
   except IOError as e:
     Wopi.log.info('msg="iopOpen: remote error on generating token" client="%s" user="%s" ' \
-                  'friendlyname="%s" mode="%s" endpoint="%s" reason="%s"' % \
-                  (req.remote_addr, userid, username, viewmode, endpoint, e))
+                  'friendlyname="%s" mode="%s" endpoint="%s" reason="%s"', \
+                  req.remote_addr, userid, username, viewmode, endpoint, e)
     return 'Remote error, file not found or file is a directory', http.client.NOT_FOUND
 
 
@@ -325,16 +403,16 @@ def iopGetOpenFiles():
   '''Returns a list of all currently opened files, for operations purposes only.
   This call is protected by the same shared secret as the /wopi/iop/open call.'''
   req = flask.request
-  if req.headers.get('Authorization') != 'Bearer ' + Wopi.iopsecret:
+  if req.headers.get('Authorization') != Wopi.iopauthheader:
     Wopi.log.warning('msg="iopGetOpenFiles: unauthorized access attempt, missing authorization token" ' \
-                     'client="%s"' % req.remote_addr)
+                     'client="%s"', req.remote_addr)
     return 'Client not authorized', http.client.UNAUTHORIZED
   # first convert the sets into lists, otherwise sets cannot be serialized in JSON format
   jlist = {}
   for f in list(Wopi.openfiles.keys()):
     jlist[f] = (Wopi.openfiles[f][0], tuple(Wopi.openfiles[f][1]))
   # dump the current list of opened files in JSON format
-  Wopi.log.info('msg="iopGetOpenFiles: returning list of open files" client="%s"' % req.remote_addr)
+  Wopi.log.info('msg="iopGetOpenFiles: returning list of open files" client="%s"', req.remote_addr)
   return flask.Response(json.dumps(jlist), mimetype='application/json')
 
 
@@ -344,26 +422,25 @@ def cboxDownload():
      so that the file's path is never explicitly visible.'''
   # TODO this endpoint should be removed altogether: the download should be directly served by Reva
   try:
-    acctok = jwt.decode(flask.request.args['access_token'], Wopi.wopisecret, algorithms=['HS256'])
-    if acctok['exp'] < time.time():
-      raise jwt.exceptions.ExpiredSignatureError
+    acctok = utils.decodeJwt(flask.request.args['access_token'])
+    # the chunks yielded by the storage layer are passed through to the WSGI server as they are
     resp = flask.Response(storage.readfile(acctok['endpoint'], acctok['filename'], acctok['userid']), \
-                          mimetype='application/octet-stream')
+                          mimetype='application/octet-stream', direct_passthrough=True)
     resp.headers['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(acctok['filename'])
     resp.status_code = http.client.OK
-    Wopi.log.info('msg="cboxDownload: direct download succeeded" filename="%s" user="%s" token="%s"' % \
-                  (acctok['filename'], acctok['userid'], flask.request.args['access_token'][-20:]))
+    Wopi.log.info('msg="cboxDownload: direct download succeeded" filename="%s" user="%s" token="%s"', \
+                  acctok['filename'], acctok['userid'], flask.request.args['access_token'][-20:])
     return resp
   except (jwt.exceptions.DecodeError, jwt.exceptions.ExpiredSignatureError) as e:
-    Wopi.log.warning('msg="Signature verification failed" client="%s" requestedUrl="%s" token="%s"' % \
-                     (flask.request.remote_addr, flask.request.base_url, flask.request.args['access_token']))
+    Wopi.log.warning('msg="Signature verification failed" client="%s" requestedUrl="%s" token="%s"', \
+                     flask.request.remote_addr, flask.request.base_url, flask.request.args['access_token'])
     return 'Invalid access token', http.client.NOT_FOUND
   except IOError as e:
-    Wopi.log.info('msg="Requested file not found" filename="%s" token="%s" error="%s"' % \
-                  (acctok['filename'], flask.request.args['access_token'][-20:], e))
+    Wopi.log.info('msg="Requested file not found" filename="%s" token="%s" error="%s"', \
+                  acctok['filename'], flask.request.args['access_token'][-20:], e)
     return 'File not found', http.client.NOT_FOUND
   except KeyError as e:
-    Wopi.log.error('msg="Invalid access token or request argument" error="%s"' % e)
+    Wopi.log.error('msg="Invalid access token or request argument" error="%s"', e)
     return 'Invalid access token', http.client.UNAUTHORIZED
 
 
@@ -375,8 +452,8 @@ def cboxEndPoints():
   Note that if the end-points are relocated and the corresponding configuration entry updated,
   the WOPI server must be restarted.'''
   # TODO this endpoint should be moved to the Apps Registry service in Reva
-  Wopi.log.info('msg="cboxEndPoints: returning all registered office apps end-points" client="%s" mimetypesCount="%d"' % \
-                (flask.request.remote_addr, len(Wopi.ENDPOINTS)))
+  Wopi.log.info('msg="cboxEndPoints: returning all registered office apps end-points" client="%s" mimetypesCount="%d"', \
+                flask.request.remote_addr, len(Wopi.ENDPOINTS))
   return flask.Response(json.dumps(Wopi.ENDPOINTS), mimetype='application/json')
 
 
@@ -408,22 +485,22 @@ def cboxLock():
   '''
   req = flask.request
   # first check if the shared secret matches ours
-  if req.headers.get('Authorization') != 'Bearer ' + Wopi.iopsecret:
+  if req.headers.get('Authorization') != Wopi.iopauthheader:
     Wopi.log.warning('msg="cboxLock: unauthorized access attempt, missing authorization token" '
-                     'client="%s"' % req.remote_addr)
+                     'client="%s"', req.remote_addr)
     return 'Client not authorized', http.client.UNAUTHORIZED
   filename = req.args['filename']
   userid = req.args['userid'] if 'userid' in req.args else '0:0'
   endpoint = req.args['endpoint'] if 'endpoint' in req.args else 'default'
   query = req.method == 'GET'
-  Wopi.log.info('msg="cboxLock: start processing" filename="%s" request="%s" userid="%s"' % \
-                (filename, "query" if query else "create", userid))
+  Wopi.log.info('msg="cboxLock: start processing" filename="%s" request="%s" userid="%s"', \
+                filename, "query" if query else "create", userid)
 
   # first make sure the file itself exists
   try:
-    filestat = storage.statx(endpoint, filename, userid, versioninv=1)
+    filestat = storage.statx(endpoint, filename, userid, versioninv=1, nocache=True)
   except IOError as e:
-    Wopi.log.warning('msg="cboxLock: target not found or not a file" filename="%s"' % filename)
+    Wopi.log.warning('msg="cboxLock: target not found or not a file" filename="%s"', filename)
     return 'File not found or file is a directory', http.client.NOT_FOUND
 
   # probe if a WOPI lock already exists and expire it if too old:
@@ -436,9 +513,9 @@ def cboxLock():
 
   # then probe the existence of a MS Office lock
   try:
-    mslockstat = storage.stat(endpoint, utils.getMicrosoftOfficeLockName(filename), userid)
-    Wopi.log.info('msg="cboxLock: found existing Microsoft Office lock" filename="%s" lockmtime="%ld"' % \
-                  (filename, mslockstat['mtime']))
+    mslockstat = storage.stat(endpoint, utils.getMicrosoftOfficeLockName(filename), userid, nocache=True)
+    Wopi.log.info('msg="cboxLock: found existing Microsoft Office lock" filename="%s" lockmtime="%ld"', \
+                  filename, mslockstat['mtime'])
     return 'Previous lock exists', http.client.CONFLICT
   except IOError as e:
     pass
@@ -447,26 +524,24 @@ def cboxLock():
     # in case of lock query, probe by reading the requested LibreOffice-compatible lock
     try:
       lock = next(storage.readfile(endpoint, utils.getLibreOfficeLockName(filename), userid))
-      if isinstance(lock, IOError):
-        raise lock
       # lock is there, check last mtime
-      lockstat = storage.stat(endpoint, utils.getLibreOfficeLockName(filename), userid)
+      lockstat = storage.stat(endpoint, utils.getLibreOfficeLockName(filename), userid, nocache=True)
     except (IOError, StopIteration) as e:
       # be optimistic, any error here (including no content in the lock file) is like ENOENT
-      Wopi.log.info('msg="cboxLock: lock being queried not found" filename="%s" reason="%s"' % \
-                    (filename, 'empty lock' if isinstance(e, StopIteration) else str(e)))
+      Wopi.log.info('msg="cboxLock: lock being queried not found" filename="%s" reason="%s"', \
+                    filename, 'empty lock' if isinstance(e, StopIteration) else str(e))
       return 'Previous lock not found', http.client.NOT_FOUND
     if filestat['mtime'] > lockstat['mtime']:
       # we were asked to query an existing lock, but the file was modified in between (e.g. by a sync client):
       # notify potential conflict
       Wopi.log.warning('msg="cboxLock: file got modified after LibreOffice-compatible lock file was created" ' \
-                       'filename="%s" request="query"' % filename)
+                       'filename="%s" request="query"', filename)
       return 'File modified since open time', http.client.CONFLICT
     # now check content
     lock = lock.decode('UTF-8')
     if 'OnlyOffice Online Editor' not in lock:
-      Wopi.log.info('msg="cboxLock: found existing LibreOffice lock" filename="%s" holder="%s" lockmtime="%ld" request="query"' % \
-                    (filename, lock.split(',')[1] if ',' in lock else lock, lockstat['mtime']))
+      Wopi.log.info('msg="cboxLock: found existing LibreOffice lock" filename="%s" holder="%s" lockmtime="%ld" request="query"', \
+                    filename, lock.split(',')[1] if ',' in lock else lock, lockstat['mtime'])
       return 'Previous lock exists', http.client.CONFLICT
     # if the lock was created for OnlyOffice, it's OK (OnlyOffice will handle the collaborative session)
     try:
@@ -474,11 +549,11 @@ def cboxLock():
       lockid = int(lock.split(';\n')[1].strip(';'))
     except (IndexError, ValueError):
       # lock got corrupted and did not contain the extra creation timestamp
-      Wopi.log.warning('msg="cboxLock: found malformed LibreOffice lock" filename="%s" holder="%s" lockmtime="%ld" request="query"' % \
-                       (filename, lock.split(',')[1] if ',' in lock else lock, lockstat['mtime']))
+      Wopi.log.warning('msg="cboxLock: found malformed LibreOffice lock" filename="%s" holder="%s" lockmtime="%ld" request="query"', \
+                       filename, lock.split(',')[1] if ',' in lock else lock, lockstat['mtime'])
       return 'Previous lock exists', http.client.CONFLICT
-    Wopi.log.info('msg="cboxLock: lock file still valid" filename="%s" mtime="%ld" lockid="%ld" lockmtime="%ld" request="query"' % \
-                  (filename, filestat['mtime'], lockid, lockstat['mtime']))
+    Wopi.log.info('msg="cboxLock: lock file still valid" filename="%s" mtime="%ld" lockid="%ld" lockmtime="%ld" request="query"', \
+                  filename, filestat['mtime'], lockid, lockstat['mtime'])
     return str(lockid), http.client.OK
 
   # else: create a LibreOffice-compatible lock, but with an extra line that contains the timestamp when it was first
@@ -488,44 +563,40 @@ def cboxLock():
   try:
     lockid = int(time.time())
     lolockcontent = ',OnlyOffice Online Editor,%s,%s,ExtWebApp;\n%d;' % \
-                    (Wopi.wopiurl, time.strftime('%d.%m.%Y %H:%M', time.localtime(time.time())), lockid)
+                    (Wopi.wopiurl, time.strftime('%d.%m.%Y %H:%M', time.localtime(lockid)), lockid)
     # try to write in exclusive mode (and if a valid WOPI lock exists, assume the corresponding LibreOffice lock
     # is still there so the write will fail)
     storage.writefile(endpoint, utils.getLibreOfficeLockName(filename), userid, lolockcontent, islock=True)
-    Wopi.log.info('msg="cboxLock: created LibreOffice-compatible lock file" filename="%s" fileid="%s" lockid="%ld"' % \
-                  (filename, filestat['inode'], lockid))
+    Wopi.log.info('msg="cboxLock: created LibreOffice-compatible lock file" filename="%s" fileid="%s" lockid="%ld"', \
+                  filename, filestat['inode'], lockid)
     return str(lockid), http.client.OK
   except IOError as e:
     if 'File exists and islock flag requested' not in str(e):
       # writing failed
-      Wopi.log.error('msg="cboxLock: unable to store LibreOffice-compatible lock file" filename="%s" reason="%s"' % \
-                     (filename, e))
+      Wopi.log.error('msg="cboxLock: unable to store LibreOffice-compatible lock file" filename="%s" reason="%s"', \
+                     filename, e)
       return 'Error locking file', http.client.INTERNAL_SERVER_ERROR
     # otherwise, a lock existed: try and read it
     try:
       lock = next(storage.readfile(endpoint, utils.getLibreOfficeLockName(filename), userid))
-      if isinstance(lock, IOError):
-        raise lock
     except (IOError, StopIteration) as e:
       #  CERNBOX-1279: another thread was faster in creating the lock, but it's still in flight (StopIteration = no content)!
       Wopi.log.warning('msg="cboxLock: detected race condition, attempting to re-read LibreOffice-compatible lock" ' \
-                       'filename="%s" reason="%s"' % (filename, 'empty lock' if isinstance(e, StopIteration) else str(e)))
+                       'filename="%s" reason="%s"', filename, 'empty lock' if isinstance(e, StopIteration) else str(e))
       # let's just try again in a short while (not too short though: 2 secs were not enough in testing)
       time.sleep(5)
       try:
         lock = next(storage.readfile(endpoint, utils.getLibreOfficeLockName(filename), userid))
-        if isinstance(lock, IOError):
-          raise lock
       except (IOError, StopIteration) as e:
         # give up
-        Wopi.log.warning('msg="cboxLock: unable to read existing LibreOffice lock" filename="%s" reason="%s"' % \
-                         (filename, 'empty lock' if isinstance(e, StopIteration) else str(e)))
+        Wopi.log.warning('msg="cboxLock: unable to read existing LibreOffice lock" filename="%s" reason="%s"', \
+                         filename, 'empty lock' if isinstance(e, StopIteration) else str(e))
         return 'Previous lock exists', http.client.CONFLICT
     lock = lock.decode('UTF-8')
     if 'OnlyOffice Online Editor' not in lock:
       # a previous lock existed and it's not held by us, fail with conflict
-      Wopi.log.warning('msg="cboxLock: found existing LibreOffice lock" filename="%s" holder="%s" request="create"' % \
-                       (filename, lock.split(',')[1] if ',' in lock else lock))
+      Wopi.log.warning('msg="cboxLock: found existing LibreOffice lock" filename="%s" holder="%s" request="create"', \
+                       filename, lock.split(',')[1] if ',' in lock else lock)
       return 'Previous lock exists', http.client.CONFLICT
     # otherwise, extract the previous timestamp and refresh the lock itself
     # (this is equivalent to a touch, needed to make the mtime check on query valid, see above)
@@ -536,18 +607,18 @@ def cboxLock():
     try:
       lockid = int(lock.split(';\n')[1].strip(';'))
       lolockcontent = ',OnlyOffice Online Editor,%s,%s,ExtWebApp;\n%d;' % \
-                      (Wopi.wopiurl, time.strftime('%d.%m.%Y %H:%M', time.localtime(time.time())), lockid)
+                      (Wopi.wopiurl, time.strftime('%d.%m.%Y %H:%M'), lockid)
       storage.writefile(endpoint, utils.getLibreOfficeLockName(filename), userid, lolockcontent, islock=False)
-      Wopi.log.info('msg="cboxLock: refreshed LibreOffice-compatible lock file" filename="%s" fileid="%s" mtime="%ld" lockid="%ld"' % \
-                    (filename, filestat['inode'], filestat['mtime'], lockid))
+      Wopi.log.info('msg="cboxLock: refreshed LibreOffice-compatible lock file" filename="%s" fileid="%s" mtime="%ld" lockid="%ld"', \
+                    filename, filestat['inode'], filestat['mtime'], lockid)
       return str(lockid), http.client.OK
     except IndexError as e:
-      Wopi.log.error('msg="cboxLock: unable to refresh LibreOffice-compatible lock file" filename="%s" lock="%s" reason="%s"' % \
-                     (filename, lock, e))
+      Wopi.log.error('msg="cboxLock: unable to refresh LibreOffice-compatible lock file" filename="%s" lock="%s" reason="%s"', \
+                     filename, lock, e)
     except IOError as e:
       # this is unexpected, return failure
-      Wopi.log.error('msg="cboxLock: unable to refresh LibreOffice-compatible lock file" filename="%s" reason="%s"' % \
-                     (filename, e))
+      Wopi.log.error('msg="cboxLock: unable to refresh LibreOffice-compatible lock file" filename="%s" reason="%s"', \
+                     filename, e)
       return 'Error relocking file', http.client.INTERNAL_SERVER_ERROR
 
 
@@ -568,20 +639,21 @@ def cboxUnlock():
   '''
   req = flask.request
   # first check if the shared secret matches ours
-  if req.headers.get('Authorization') != 'Bearer ' + Wopi.iopsecret:
+  if req.headers.get('Authorization') != Wopi.iopauthheader:
     Wopi.log.warning('msg="cboxUnlock: unauthorized access attempt, missing authorization token" ' \
-                     'client="%s"' % req.remote_addr)
+                     'client="%s"', req.remote_addr)
     return 'Client not authorized', http.client.UNAUTHORIZED
   filename = req.args['filename']
   userid = req.args['userid'] if 'userid' in req.args else '0:0'
   endpoint = req.args['endpoint'] if 'endpoint' in req.args else 'default'
-  Wopi.log.info('msg="cboxUnlock: start processing" filename="%s"' % filename)
+  Wopi.log.info('msg="cboxUnlock: start processing" filename="%s"', filename)
   try:
     # probe if a WOPI/LibreOffice lock exists with the expected signature
-    lock = next(storage.readfile(endpoint, utils.getLibreOfficeLockName(filename), userid))
-    if isinstance(lock, IOError):
+    try:
+      lock = next(storage.readfile(endpoint, utils.getLibreOfficeLockName(filename), userid))
+    except IOError:
       # typically ENOENT, any other error is grouped here
-      Wopi.log.warning('msg="cboxUnlock: lock file not found" filename="%s"' % filename)
+      Wopi.log.warning('msg="cboxUnlock: lock file not found" filename="%s"', filename)
       return 'Lock not found', http.client.NOT_FOUND
     lock = lock.decode('UTF-8')
     if 'OnlyOffice Online Editor' in lock:
@@ -589,16 +661,16 @@ def cboxUnlock():
       storage.removefile(endpoint, utils.getLibreOfficeLockName(filename), userid, 1)
       # and log this along with the previous lockid for reference
       lockid = int(lock.split(';\n')[1].strip(';'))
-      Wopi.log.info('msg="cboxUnlock: successfully removed LibreOffice-compatible lock file" filename="%s" lockid="%ld"' % \
-                    (filename, lockid))
+      Wopi.log.info('msg="cboxUnlock: successfully removed LibreOffice-compatible lock file" filename="%s" lockid="%ld"', \
+                    filename, lockid)
       return 'OK', http.client.OK
     # else another lock exists
-    Wopi.log.warning('msg="cboxUnlock: lock file held by another application" filename="%s" holder="%s"' % \
-                     (filename, lock.split(',')[1] if ',' in lock else lock))
+    Wopi.log.warning('msg="cboxUnlock: lock file held by another application" filename="%s" holder="%s"', \
+                     filename, lock.split(',')[1] if ',' in lock else lock)
     return 'Lock held by another application', http.client.CONFLICT
   except (IOError, StopIteration) as e:
-    Wopi.log.error('msg="cboxUnlock: remote error with the requested lock" filename="%s" reason="%s"' % \
-                   (filename, 'empty lock' if isinstance(e, StopIteration) else str(e)))
+    Wopi.log.error('msg="cboxUnlock: remote error with the requested lock" filename="%s" reason="%s"', \
+                   filename, 'empty lock' if isinstance(e, StopIteration) else str(e))
     return 'Error unlocking file', http.client.INTERNAL_SERVER_ERROR
 
 
@@ -609,24 +681,26 @@ def cboxUnlock():
 def wopiCheckFileInfo(fileid):
   '''Implements the CheckFileInfo WOPI call'''
   # cf. http://wopi.readthedocs.io/projects/wopirest/en/latest/files/CheckFileInfo.html
-  Wopi.refreshconfig()
   try:
-    acctok = jwt.decode(flask.request.args['access_token'], Wopi.wopisecret, algorithms=['HS256'])
-    acctok['viewmode'] = utils.ViewMode(acctok['viewmode'])
-    if acctok['exp'] < time.time():
-      raise jwt.exceptions.ExpiredSignatureError
-    Wopi.log.info('msg="CheckFileInfo" user="%s" filename="%s" fileid="%s" token="%s"' % \
-                  (acctok['userid'], acctok['filename'], fileid, flask.request.args['access_token'][-20:]))
-    statInfo = storage.statx(acctok['endpoint'], acctok['filename'], acctok['userid'])
-    # compute some entities for the response
-    wopiSrc = 'WOPISrc=%s&access_token=%s' % (utils.generateWopiSrc(fileid), flask.request.args['access_token'])
-    fExt = os.path.splitext(acctok['filename'])[1]
+    token = flask.request.args['access_token']
+    acctok = utils.decodeJwt(token)
+    # bind the token fields used throughout this call to locals
+    endpoint, filename, userid = acctok['endpoint'], acctok['filename'], acctok['userid']
+    viewmode = utils.ViewMode(acctok['viewmode'])
+    Wopi.log.info('msg="CheckFileInfo" user="%s" filename="%s" fileid="%s" token="%s"', \
+                  userid, filename, fileid, token[-20:])
+    statInfo = storage.statx(endpoint, filename, userid)
+    # compute some entities for the response: the path is split only once in its components
+    wopiSrc = 'WOPISrc=%s&access_token=%s' % (utils.generateWopiSrc(fileid), token)
+    dirname, _, basename = filename.rpartition('/')
+    fExt = os.path.splitext(basename)[1]
     # populate metadata for this file
     filemd = {}
-    filemd['BaseFileName'] = filemd['BreadcrumbDocName'] = os.path.basename(acctok['filename'])
+    filemd['BaseFileName'] = filemd['BreadcrumbDocName'] = basename
     furl = acctok['folderurl']
     # encode the path part as it is going to be an URL GET argument
-    filemd['BreadcrumbFolderUrl'] = furl[:furl.find('=')+1] + urllib.parse.quote_plus(furl[furl.find('=')+1:])
+    furlsep = furl.find('=') + 1
+    filemd['BreadcrumbFolderUrl'] = furl[:furlsep] + urllib.parse.quote_plus(furl[furlsep:])
     if acctok['username'] == '':
       filemd['UserFriendlyName'] = 'Guest ' + utils.randomString(3)
       if '?path' in furl and furl[-1] != '=':
@@ -637,72 +711,72 @@ def wopiCheckFileInfo(fileid):
         filemd['BreadcrumbFolderName'] = 'Back to the CERNBox share'
     else:
       filemd['UserFriendlyName'] = acctok['username']
-      filemd['BreadcrumbFolderName'] = 'Back to ' + acctok['filename'].split('/')[-2]
-    if acctok['viewmode'] in (utils.ViewMode.READ_ONLY, utils.ViewMode.READ_WRITE):
+      filemd['BreadcrumbFolderName'] = 'Back to ' + dirname.rpartition('/')[2]
+    if viewmode in (utils.ViewMode.READ_ONLY, utils.ViewMode.READ_WRITE):
       filemd['DownloadUrl'] = '%s?access_token=%s' % \
-                              (Wopi.config.get('general', 'downloadurl'), flask.request.args['access_token'])
+                              (Wopi.downloadurl, token)
     filemd['OwnerId'] = statInfo['userid']
-    filemd['UserId'] = acctok['userid']     # typically same as OwnerId; different when accessing shared documents
+    filemd['UserId'] = userid     # typically same as OwnerId; different when accessing shared documents
     filemd['Size'] = statInfo['size']
     # TODO the version is generated like this in ownCloud: 'V' . $file->getEtag() . \md5($file->getChecksum());
     filemd['Version'] = statInfo['mtime']   # mtime is used as version here
     filemd['SupportsExtendedLockLength'] = filemd['SupportsGetLock'] = True
     filemd['SupportsUpdate'] = filemd['UserCanWrite'] = filemd['SupportsLocks'] = filemd['SupportsRename'] = \
-        filemd['SupportsDeleteFile'] = filemd['UserCanRename'] = acctok['viewmode'] == utils.ViewMode.READ_WRITE
-    filemd['UserCanNotWriteRelative'] = acctok['viewmode'] != utils.ViewMode.READ_WRITE
+        filemd['SupportsDeleteFile'] = filemd['UserCanRename'] = viewmode == utils.ViewMode.READ_WRITE
+    filemd['UserCanNotWriteRelative'] = viewmode != utils.ViewMode.READ_WRITE
     # populate app-specific metadata
     # the following properties are only used by MS Office Online
-    if fExt in ['.docx', '.xlsx', '.pptx']:
+    if fExt in {'.docx', '.xlsx', '.pptx'}:
       # TODO once the endpoints are managed by Reva, this metadata has to be provided in the initial /open call
       filemd['HostViewUrl'] = '%s&%s' % (Wopi.ENDPOINTS[fExt]['view'], wopiSrc)
       filemd['HostEditUrl'] = '%s&%s' % (Wopi.ENDPOINTS[fExt]['edit'], wopiSrc)
       # the following actions are broken in MS Office Online, therefore they are disabled
       filemd['SupportsRename'] = filemd['UserCanRename'] = False
     # the following is to enable the 'Edit in Word/Excel/PowerPoint' (desktop) action (probably broken)
-    try:
-      filemd['ClientUrl'] = Wopi.config.get('general', 'webdavurl') + '/' + acctok['filename']
-    except configparser.NoOptionError:
-      # if no WebDAV URL is provided, ignore this setting
-      pass
+    # if no WebDAV URL is provided, ignore this setting
+    if Wopi.webdavurl:
+      filemd['ClientUrl'] = Wopi.webdavurl + '/' + filename
     # extensions for Collabora Online
     filemd['EnableOwnerTermination'] = True
-    filemd['DisableExport'] = filemd['DisableCopy'] = filemd['DisablePrint'] = acctok['viewmode'] == utils.ViewMode.VIEW_ONLY
+    filemd['DisableExport'] = filemd['DisableCopy'] = filemd['DisablePrint'] = viewmode == utils.ViewMode.VIEW_ONLY
     #filemd['LastModifiedTime'] = datetime.fromtimestamp(int(statInfo['mtime'])).isoformat()   # this currently breaks
 
-    Wopi.log.info('msg="File metadata response" token="%s" metadata="%s"' % (flask.request.args['access_token'][-20:], filemd))
-    return flask.Response(json.dumps(filemd), mimetype='application/json')
+    Wopi.log.info('msg="File metadata response" token="%s" metadata="%s"', token[-20:], filemd)
+    return flask.Response(json.dumps(filemd, separators=(',', ':')), mimetype='application/json')
   except (jwt.exceptions.DecodeError, jwt.exceptions.ExpiredSignatureError) as e:
-    Wopi.log.warning('msg="Signature verification failed" client="%s" requestedUrl="%s" token="%s"' % \
-                     (flask.request.remote_addr, flask.request.base_url, flask.request.args['access_token']))
+    Wopi.log.warning('msg="Signature verification failed" client="%s" requestedUrl="%s" token="%s"', \
+                     flask.request.remote_addr, flask.request.base_url, token)
     return 'Invalid access token', http.client.NOT_FOUND
   except IOError as e:
-    Wopi.log.info('msg="Requested file not found" filename="%s" token="%s" error="%s"' % \
-                  (acctok['filename'], flask.request.args['access_token'][-20:], e))
+    Wopi.log.info('msg="Requested file not found" filename="%s" token="%s" error="%s"', \
+                  filename, token[-20:], e)
     return 'File not found', http.client.NOT_FOUND
   except KeyError as e:
-    Wopi.log.error('msg="Invalid access token or request argument" error="%s"' % e)
+    Wopi.log.error('msg="Invalid access token or request argument" error="%s"', e)
     return 'Invalid access token', http.client.UNAUTHORIZED
 
 
 @Wopi.app.route("/wopi/files/<fileid>/contents", methods=['GET'])
 def wopiGetFile(fileid):
   '''Implements the GetFile WOPI call'''
-  Wopi.refreshconfig()
   try:
-    acctok = jwt.decode(flask.request.args['access_token'], Wopi.wopisecret, algorithms=['HS256'])
-    if acctok['exp'] < time.time():
-      raise jwt.exceptions.ExpiredSignatureError
-    Wopi.log.info('msg="GetFile" user="%s" filename="%s" fileid="%s" token="%s"' % \
-                  (acctok['userid'], acctok['filename'], fileid, flask.request.args['access_token'][-20:]))
+    acctok = utils.decodeJwt(flask.request.args['access_token'])
+    Wopi.log.info('msg="GetFile" user="%s" filename="%s" fileid="%s" token="%s"', \
+                  acctok['userid'], acctok['filename'], fileid, flask.request.args['access_token'][-20:])
     # stream file from storage to client
+    # the chunks yielded by the storage layer are passed through to the WSGI server as they are
     resp = flask.Response(storage.readfile(acctok['endpoint'], acctok['filename'], acctok['userid']), \
-                          mimetype='application/octet-stream')
+                          mimetype='application/octet-stream', direct_passthrough=True)
     resp.status_code = http.client.OK
     return resp
   except (jwt.exceptions.DecodeError, jwt.exceptions.ExpiredSignatureError) as e:
-    Wopi.log.warning('msg="Signature verification failed" client="%s" requestedUrl="%s" error="%s" token="%s"' % \
-                     (flask.request.remote_addr, flask.request.base_url, e, flask.request.args['access_token']))
+    Wopi.log.warning('msg="Signature verification failed" client="%s" requestedUrl="%s" error="%s" token="%s"', \
+                     flask.request.remote_addr, flask.request.base_url, e, flask.request.args['access_token'])
     return 'Invalid access token', http.client.UNAUTHORIZED
+  except IOError as e:
+    Wopi.log.info('msg="Requested file not found" filename="%s" token="%s" error="%s"', \
+                  acctok['filename'], flask.request.args['access_token'][-20:], e)
+    return 'File not found', http.client.NOT_FOUND
 
 
 #
@@ -764,9 +838,9 @@ def wopiLock(fileid, reqheaders, acctok):
       return utils.makeConflictResponse(op, retrievedLock, lock, oldLock, acctok['filename'])
     wopiUnlock(fileid, reqheaders, acctok, force=True)
     Wopi.log.warning('msg="Lock: BLINDLY removed the existing lock to unblock client" op="%s" user="%s" '\
-                     'filename="%s" token="%s"' % \
-                     (op, acctok['userid'], acctok['filename'], \
-                      flask.request.args['access_token'][-20:]))
+                     'filename="%s" token="%s"', \
+                     op, acctok['userid'], acctok['filename'], \
+                      flask.request.args['access_token'][-20:])
   # LOCK or REFRESH_LOCK: set the lock to the given one, including the expiration time
   try:
     utils.storeWopiLock(op, lock, acctok, os.path.splitext(acctok['filename'])[1] in Wopi.nonofficetypes)
@@ -787,16 +861,16 @@ def wopiLock(fileid, reqheaders, acctok):
       storage.setxattr(acctok['endpoint'], acctok['filename'], acctok['userid'], utils.LASTSAVETIMEKEY, int(time.time()))
     except IOError as e:
       # not fatal, but will generate a conflict file later on, so log a warning
-      Wopi.log.warning('msg="Unable to set lastwritetime xattr" user="%s" filename="%s" token="%s" reason="%s"' % \
-                       (acctok['userid'], acctok['filename'], flask.request.args['access_token'][-20:], e))
+      Wopi.log.warning('msg="Unable to set lastwritetime xattr" user="%s" filename="%s" token="%s" reason="%s"', \
+                       acctok['userid'], acctok['filename'], flask.request.args['access_token'][-20:], e)
     # also, keep track of files that have been opened for write: this is for statistical purposes only
     # (cf. the GetLock WOPI call and the /wopi/cbox/open/list action)
     if acctok['filename'] not in Wopi.openfiles:
       Wopi.openfiles[acctok['filename']] = (time.asctime(), set([acctok['username']]))
     else:
       # the file was already opened but without lock: this happens on new files (cf. editnew action), just log
-      Wopi.log.info('msg="First lock for new file" user="%s" filename="%s" token="%s"' % \
-                    (acctok['userid'], acctok['filename'], flask.request.args['access_token'][-20:]))
+      Wopi.log.info('msg="First lock for new file" user="%s" filename="%s" token="%s"', \
+                    acctok['userid'], acctok['filename'], flask.request.args['access_token'][-20:])
   return 'OK', http.client.OK
 
 
@@ -815,13 +889,13 @@ def wopiGetLock(fileid, _reqheaders_unused, acctok):
         Wopi.openfiles[acctok['filename']][1].add(acctok['username'])
         if len(Wopi.openfiles[acctok['filename']][1]) > 1:
           # for later monitoring, explicitly log that this file is being edited by at least two users
-          Wopi.log.info('msg="Collaborative editing detected" filename="%s" token="%s" users="%s"' % \
-                         (acctok['filename'], flask.request.args['access_token'][-20:],
-                          list(Wopi.openfiles[acctok['filename']][1])))
+          Wopi.log.info('msg="Collaborative editing detected" filename="%s" token="%s" users="%s"', \
+                         acctok['filename'], flask.request.args['access_token'][-20:],
+                          list(Wopi.openfiles[acctok['filename']][1]))
     except KeyError:
       # existing lock but missing Wopi.openfiles[acctok['filename']] ?
-      Wopi.log.warning('msg="Repopulating missing metadata" filename="%s" token="%s" user="%s"' % \
-                       (acctok['filename'], flask.request.args['access_token'][-20:], acctok['username']))
+      Wopi.log.warning('msg="Repopulating missing metadata" filename="%s" token="%s" user="%s"', \
+                       acctok['filename'], flask.request.args['access_token'][-20:], acctok['username'])
       Wopi.openfiles[acctok['filename']] = (time.asctime(), set([acctok['username']]))
   # we might want to check if a non-WOPI lock exists for this file:
   #try:
@@ -841,9 +915,9 @@ def wopiPutRelative(fileid, reqheaders, acctok):
   relTarget = reqheaders.get('X-WOPI-RelativeTarget')
   overwriteTarget = bool(reqheaders.get('X-WOPI-OverwriteRelativeTarget'))
   Wopi.log.info('msg="PutRelative" user="%s" filename="%s" fileid="%s" suggTarget="%s" relTarget="%s" '
-                'overwrite="%r" token="%s"' % \
-                (acctok['userid'], acctok['filename'], fileid, \
-                 suggTarget, relTarget, overwriteTarget, flask.request.args['access_token'][-20:]))
+                'overwrite="%r" token="%s"', \
+                acctok['userid'], acctok['filename'], fileid, \
+                 suggTarget, relTarget, overwriteTarget, flask.request.args['access_token'][-20:])
   # either one xor the other must be present; note we can't use `^` as we have a mix of str and NoneType
   if (suggTarget and relTarget) or (not suggTarget and not relTarget):
     return 'Not supported', http.client.NOT_IMPLEMENTED
@@ -865,9 +939,9 @@ def wopiPutRelative(fileid, reqheaders, acctok):
           # OK, the targetName is good to go
           break
         # we got another error with this file, fail
-        Wopi.log.info('msg="PutRelative" user="%s" filename="%s" token="%s" suggTarget="%s" error="%s"' % \
-                      (acctok['userid'], targetName, flask.request.args['access_token'][-20:], \
-                       suggTarget, str(e)))
+        Wopi.log.info('msg="PutRelative" user="%s" filename="%s" token="%s" suggTarget="%s" error="%s"', \
+                      acctok['userid'], targetName, flask.request.args['access_token'][-20:], \
+                       suggTarget, str(e))
         return 'Illegal filename %s: %s' % (targetName, e), http.client.BAD_REQUEST
   else:
     # the relative target is a filename to be respected, and that may overwrite an existing file
@@ -887,13 +961,13 @@ def wopiPutRelative(fileid, reqheaders, acctok):
   try:
     utils.storeWopiFile(flask.request, acctok, utils.LASTSAVETIMEKEY, targetName)
   except IOError as e:
-    Wopi.log.info('msg="Error writing file" filename="%s" token="%s" error="%s"' % \
-                  (targetName, flask.request.args['access_token'][-20:], e))
+    Wopi.log.info('msg="Error writing file" filename="%s" token="%s" error="%s"', \
+                  targetName, flask.request.args['access_token'][-20:], e)
     return 'I/O Error', http.client.INTERNAL_SERVER_ERROR
   # generate an access token for the new file
   Wopi.log.info('msg="PutRelative: generating new access token" user="%s" filename="%s" ' \
-                'mode="ViewMode.READ_WRITE" friendlyname="%s"' % \
-                (acctok['userid'], targetName, acctok['username']))
+                'mode="ViewMode.READ_WRITE" friendlyname="%s"', \
+                acctok['userid'], targetName, acctok['username'])
   inode, newacctok = utils.generateAccessToken(acctok['userid'], targetName, utils.ViewMode.READ_WRITE, acctok['username'], \
                                                acctok['folderurl'], acctok['endpoint'])
   # prepare and send the response as JSON
@@ -907,7 +981,7 @@ def wopiPutRelative(fileid, reqheaders, acctok):
                               (Wopi.ENDPOINTS[fExt]['edit'], \
                                utils.generateWopiSrc(inode), newacctok)
   #else we don't know the app to edit this file type, therefore we do not provide the info
-  Wopi.log.debug('msg="PutRelative response" token="%s" metadata="%s"' % (newacctok[-20:], putrelmd))
+  Wopi.log.debug('msg="PutRelative response" token="%s" metadata="%s"', newacctok[-20:], putrelmd)
   return flask.Response(json.dumps(putrelmd), mimetype='application/json')
 
 
@@ -921,7 +995,7 @@ def wopiDeleteFile(fileid, _reqheaders_unused, acctok):
     storage.removefile(acctok['endpoint'], acctok['filename'], acctok['userid'])
     return 'OK', http.client.OK
   except IOError as e:
-    Wopi.log.info('msg="DeleteFile" token="%s" error="%s"' % (flask.request.args['access_token'][-20:], e))
+    Wopi.log.info('msg="DeleteFile" token="%s" error="%s"', flask.request.args['access_token'][-20:], e)
     return 'Internal error', http.client.INTERNAL_SERVER_ERROR
 
 
@@ -935,8 +1009,8 @@ def wopiRenameFile(fileid, reqheaders, acctok):
   try:
     # the destination name comes without base path and without extension
     targetName = os.path.dirname(acctok['filename']) + '/' + targetName + os.path.splitext(acctok['filename'])[1]
-    Wopi.log.info('msg="RenameFile" user="%s" filename="%s" token="%s" targetname="%s"' % \
-                  (acctok['userid'], acctok['filename'], flask.request.args['access_token'][-20:], targetName))
+    Wopi.log.info('msg="RenameFile" user="%s" filename="%s" token="%s" targetname="%s"', \
+                  acctok['userid'], acctok['filename'], flask.request.args['access_token'][-20:], targetName)
     storage.renamefile(acctok['endpoint'], acctok['filename'], targetName, acctok['userid'])
     # also rename the locks
     storage.renamefile(acctok['endpoint'], utils.getLockName(acctok['filename']), utils.getLockName(targetName), \
@@ -949,7 +1023,7 @@ def wopiRenameFile(fileid, reqheaders, acctok):
     return flask.Response(json.dumps(renamemd), mimetype='application/json')
   except IOError as e:
     # assume the rename failed because of the destination filename and report the error
-    Wopi.log.info('msg="RenameFile" token="%s" error="%s"' % (flask.request.args['access_token'][-20:], e))
+    Wopi.log.info('msg="RenameFile" token="%s" error="%s"', flask.request.args['access_token'][-20:], e)
     resp = flask.Response()
     resp.headers['X-WOPI-InvalidFileNameError'] = 'Failed to rename: %s' % e
     resp.status_code = http.client.BAD_REQUEST
@@ -958,132 +1032,131 @@ def wopiRenameFile(fileid, reqheaders, acctok):
 
 def wopiCreateNewFile(fileid, acctok):
   '''Implements the editnew action as part of the PutFile WOPI call.'''
-  Wopi.log.info('msg="PutFile" user="%s" filename="%s" fileid="%s" action="editnew" token="%s"' % \
-                (acctok['userid'], acctok['filename'], fileid, flask.request.args['access_token'][-20:]))
+  Wopi.log.info('msg="PutFile" user="%s" filename="%s" fileid="%s" action="editnew" token="%s"', \
+                acctok['userid'], acctok['filename'], fileid, flask.request.args['access_token'][-20:])
   try:
     # try to stat the file and raise IOError if not there
     if storage.stat(acctok['endpoint'], acctok['filename'], acctok['userid'])['size'] == 0:
       # a 0-size file is equivalent to not existing
       raise IOError
-    Wopi.log.warning('msg="PutFile" error="File exists but no WOPI lock provided" filename="%s" token="%s"' %
-                     (acctok['filename'], flask.request.args['access_token']))
+    Wopi.log.warning('msg="PutFile" error="File exists but no WOPI lock provided" filename="%s" token="%s"', \
+                     acctok['filename'], flask.request.args['access_token'])
     return 'File exists', http.client.CONFLICT
   except IOError:
     # indeed the file did not exist, so we write it for the first time
     utils.storeWopiFile(flask.request, acctok, utils.LASTSAVETIMEKEY)
-    Wopi.log.info('msg="File stored successfully" action="editnew" user="%s" filename="%s" token="%s"' % \
-                  (acctok['userid'], acctok['filename'], flask.request.args['access_token']))
+    Wopi.log.info('msg="File stored successfully" action="editnew" user="%s" filename="%s" token="%s"', \
+                  acctok['userid'], acctok['filename'], flask.request.args['access_token'])
     # and we keep track of it as an open file with timestamp = Epoch, despite not having any lock yet.
     # XXX this is to work around an issue with concurrent editing of newly created files (cf. cboxOpen)
     Wopi.openfiles[acctok['filename']] = ('0', set([acctok['username']]))
     return 'OK', http.client.OK
 
 
+# dispatch table of the operations supported by wopiFilesPost(), keyed by the X-WOPI-Override header
+POSTOPS = {'LOCK': wopiLock,
+           'REFRESH_LOCK': wopiLock,
+           'UNLOCK': wopiUnlock,
+           'GET_LOCK': wopiGetLock,
+           'PUT_RELATIVE': wopiPutRelative,
+           'DELETE': wopiDeleteFile,
+           'RENAME_FILE': wopiRenameFile,
+           #'PUT_USER_INFO': https://wopirest.readthedocs.io/en/latest/files/PutUserInfo.html
+          }
+
+
 @Wopi.app.route("/wopi/files/<fileid>", methods=['POST'])
 def wopiFilesPost(fileid):
   '''A dispatcher metod for all POST operations on files'''
-  Wopi.refreshconfig()
   try:
-    acctok = jwt.decode(flask.request.args['access_token'], Wopi.wopisecret, algorithms=['HS256'])
-    if acctok['exp'] < time.time():
-      raise jwt.exceptions.ExpiredSignatureError
+    acctok = utils.decodeJwt(flask.request.args['access_token'])
     headers = flask.request.headers
     op = headers['X-WOPI-Override']       # must be one of the following strings, throws KeyError if missing
     if op != 'GET_LOCK' and utils.ViewMode(acctok['viewmode']) != utils.ViewMode.READ_WRITE:
       # protect this call if the WOPI client does not have privileges
       return 'Attempting to perform a write operation using a read-only token', http.client.UNAUTHORIZED
-    if op in ('LOCK', 'REFRESH_LOCK'):
-      return wopiLock(fileid, headers, acctok)
-    if op == 'UNLOCK':
-      return wopiUnlock(fileid, headers, acctok)
-    if op == 'GET_LOCK':
-      return wopiGetLock(fileid, headers, acctok)
-    if op == 'PUT_RELATIVE':
-      return wopiPutRelative(fileid, headers, acctok)
-    if op == 'DELETE':
-      return wopiDeleteFile(fileid, headers, acctok)
-    if op == 'RENAME_FILE':
-      return wopiRenameFile(fileid, headers, acctok)
-    #elif op == 'PUT_USER_INFO':   https://wopirest.readthedocs.io/en/latest/files/PutUserInfo.html
-    # Any other op is unsupported
-    Wopi.log.warning('msg="Unknown/unsupported operation" operation="%s"' % op)
-    return 'Not supported operation found in header', http.client.NOT_IMPLEMENTED
+    handler = POSTOPS.get(op)
+    if handler is None:
+      # any other op is unsupported
+      Wopi.log.warning('msg="Unknown/unsupported operation" operation="%s"', op)
+      return 'Not supported operation found in header', http.client.NOT_IMPLEMENTED
+    return handler(fileid, headers, acctok)
   except (jwt.exceptions.DecodeError, jwt.exceptions.ExpiredSignatureError) as e:
-    Wopi.log.warning('msg="Signature verification failed" client="%s" requestedUrl="%s" error="%s" token="%s"' % \
-                     (flask.request.remote_addr, flask.request.base_url, e, flask.request.args['access_token']))
+    Wopi.log.warning('msg="Signature verification failed" client="%s" requestedUrl="%s" error="%s" token="%s"', \
+                     flask.request.remote_addr, flask.request.base_url, e, flask.request.args['access_token'])
     return 'Invalid access token', http.client.NOT_FOUND
 
 
 @Wopi.app.route("/wopi/files/<fileid>/contents", methods=['POST'])
 def wopiPutFile(fileid):
   '''Implements the PutFile WOPI call'''
-  Wopi.refreshconfig()
   try:
-    acctok = jwt.decode(flask.request.args['access_token'], Wopi.wopisecret, algorithms=['HS256'])
-    if acctok['exp'] < time.time():
-      raise jwt.exceptions.ExpiredSignatureError
+    acctok = utils.decodeJwt(flask.request.args['access_token'])
     if 'X-WOPI-Lock' not in flask.request.headers:
       # no lock given: assume we are in creation mode (cf. editnew WOPI action)
       return wopiCreateNewFile(fileid, acctok)
+    # bind the token fields used throughout this call to locals
+    endpoint, filename, userid = acctok['endpoint'], acctok['filename'], acctok['userid']
+    encacctok = flask.request.args['access_token'][-20:]
     # otherwise, check that the caller holds the current lock on the file
     lock = flask.request.headers['X-WOPI-Lock']
     retrievedLock = utils.retrieveWopiLock(fileid, 'PUTFILE', lock, acctok)
     if retrievedLock is None:
-      return utils.makeConflictResponse('PUTFILE', retrievedLock, lock, '', acctok['filename'], \
+      return utils.makeConflictResponse('PUTFILE', retrievedLock, lock, '', filename, \
                                         'Cannot overwrite unlocked file')
     elif not utils.compareWopiLocks(retrievedLock, lock):
-      return utils.makeConflictResponse('PUTFILE', retrievedLock, lock, '', acctok['filename'], \
+      return utils.makeConflictResponse('PUTFILE', retrievedLock, lock, '', filename, \
                                         'Cannot overwrite file locked by another application')
     # OK, we can save the file now
-    Wopi.log.info('msg="PutFile" user="%s" filename="%s" fileid="%s" action="edit" token="%s"' % \
-                  (acctok['userid'], acctok['filename'], fileid, flask.request.args['access_token'][-20:]))
+    Wopi.log.info('msg="PutFile" user="%s" filename="%s" fileid="%s" action="edit" token="%s"', \
+                  userid, filename, fileid, encacctok)
     try:
-      # check now the destination file against conflicts
-      savetime = storage.getxattr(acctok['endpoint'], acctok['filename'], acctok['userid'], utils.LASTSAVETIMEKEY)
+      # check now the destination file against conflicts: this must bypass any cached metadata,
+      # as the file may have been updated by other processes or external clients
+      savetime = storage.getxattr(endpoint, filename, userid, utils.LASTSAVETIMEKEY, nocache=True)
       mtime = None
-      mtime = storage.stat(acctok['endpoint'], acctok['filename'], acctok['userid'])['mtime']
+      mtime = storage.stat(endpoint, filename, userid, nocache=True)['mtime']
       if savetime is None or not savetime.isdigit() or int(mtime) > int(savetime):
         # no xattr was there or we got our xattr but mtime is more recent: someone may have updated the file
         # from a different source (e.g. FUSE or SMB mount), therefore force conflict.
         # Note we can't get a time resolution better than one second!
         Wopi.log.info('msg="Forcing conflict based on lastWopiSaveTime" user="%s" filename="%s" ' \
-                      'savetime="%s" lastmtime="%s" token="%s"' % \
-                      (acctok['userid'], acctok['filename'], \
-                       savetime, mtime, flask.request.args['access_token'][-20:]))
+                      'savetime="%s" lastmtime="%s" token="%s"', \
+                      userid, filename, savetime, mtime, encacctok)
         raise IOError
-      Wopi.log.debug('msg="Got lastWopiSaveTime" user="%s" filename="%s" savetime="%s" lastmtime="%s" token="%s"' % \
-                     (acctok['userid'], acctok['filename'], savetime, mtime, flask.request.args['access_token'][-20:]))
+      Wopi.log.debug('msg="Got lastWopiSaveTime" user="%s" filename="%s" savetime="%s" lastmtime="%s" token="%s"', \
+                     userid, filename, savetime, mtime, encacctok)
 
     except IOError:
       # either the file was deleted or it was updated/overwritten by others: force conflict
-      newname, ext = os.path.splitext(acctok['filename'])
+      newname, ext = os.path.splitext(filename)
       # !!! typical EFSS formats are like '<filename>_conflict-<date>-<time>', but they're not synchronized back !!!
       newname = '%s-conflict-%s%s' % (newname, time.strftime('%Y%m%d-%H%M%S'), ext.strip())
       utils.storeWopiFile(flask.request, acctok, utils.LASTSAVETIMEKEY, newname)
       # keep track of this action in the original file's xattr, to avoid looping (see below)
-      storage.setxattr(acctok['endpoint'], acctok['filename'], acctok['userid'], utils.LASTSAVETIMEKEY, 0)
-      Wopi.log.info('msg="Conflicting copy created" user="%s" savetime="%s" lastmtime="%s" newfilename="%s" token="%s"' % \
-                    (acctok['userid'], savetime, mtime, newname, flask.request.args['access_token'][-20:]))
+      storage.setxattr(endpoint, filename, userid, utils.LASTSAVETIMEKEY, 0)
+      Wopi.log.info('msg="Conflicting copy created" user="%s" savetime="%s" lastmtime="%s" newfilename="%s" token="%s"', \
+                    userid, savetime, mtime, newname, encacctok)
       # and report failure to the application: note we use a CONFLICT response as it is better handled by the app
-      return utils.makeConflictResponse('PUTFILE', 'External', lock, '', acctok['filename'], \
+      return utils.makeConflictResponse('PUTFILE', 'External', lock, '', filename, \
                                         'The file being edited got moved or overwritten, conflict copy created')
 
     # Go for overwriting the file. Note that the entire check+write operation should be atomic,
     # but the previous check still gives the opportunity of a race condition. We just live with it.
     # Anyhow, the EFSS should support versioning for such cases.
     utils.storeWopiFile(flask.request, acctok, utils.LASTSAVETIMEKEY)
-    Wopi.log.info('msg="File stored successfully" action="edit" user="%s" filename="%s" token="%s"' % \
-                  (acctok['userid'], acctok['filename'], flask.request.args['access_token'][-20:]))
+    Wopi.log.info('msg="File stored successfully" action="edit" user="%s" filename="%s" token="%s"', \
+                  userid, filename, encacctok)
     return 'OK', http.client.OK
 
   except (jwt.exceptions.DecodeError, jwt.exceptions.ExpiredSignatureError) as e:
-    Wopi.log.warning('msg="Signature verification failed" client="%s" requestedUrl="%s" token="%s"' % \
-                     (flask.request.remote_addr, flask.request.base_url, flask.request.args['access_token']))
+    Wopi.log.warning('msg="Signature verification failed" client="%s" requestedUrl="%s" token="%s"', \
+                     flask.request.remote_addr, flask.request.base_url, flask.request.args['access_token'])
     return 'Invalid access token', http.client.NOT_FOUND
 
   except IOError as e:
-    Wopi.log.error('msg="Error writing file" filename="%s" token="%s" error="%s"' % \
-                   (acctok['filename'], flask.request.args['access_token'], e))
+    Wopi.log.error('msg="Error writing file" filename="%s" token="%s" error="%s"', \
+                   acctok['filename'], flask.request.args['access_token'], e)
     return 'I/O Error', http.client.INTERNAL_SERVER_ERROR
 
 
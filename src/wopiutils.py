@@ -8,7 +8,10 @@ import sys
 import os
 import time
 import traceback
+import logging
 import hashlib
+import hmac
+import base64
 import json
 from urllib.parse import quote_plus as url_quote_plus
 from enum import Enum
@@ -24,6 +27,17 @@ LASTSAVETIMEKEY = 'iop.wopi.lastwritetime'
 # standard error thrown when attempting to overwrite a file in O_EXCL mode
 EXCL_ERROR = 'File exists and islock flag requested'
 
+# the base64url-encoded header of our JSON Web Tokens: it is constant as we only issue HS256 tokens
+JWTHEADER = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b'=')
+
+# the logging levels handled by the JsonLogger facade
+LOGLEVELS = {'debug': logging.DEBUG,
+             'info': logging.INFO,
+             'warning': logging.WARNING,
+             'error': logging.ERROR,
+             'fatal': logging.FATAL,
+            }
+
 # convenience references to global entities
 st = None
 wopi = None
@@ -51,10 +65,14 @@ class JsonLogger:
     '''Facade method'''
     def facade(*args, **kwargs):
       '''internal method returned by getattr and wrapping the original one'''
-      if name in ['debug', 'info', 'warning', 'error', 'fatal']:
-        # as we use a `key="value" ...` format in all logs, we only have args[0]
-        msg = args[0] + ' '
+      if name in LOGLEVELS:
+        if not self.logger.isEnabledFor(LOGLEVELS[name]):
+          # skip any formatting work if this record is not going to be emitted
+          return None
         try:
+          # as we use a `key="value" ...` format in all logs, we only have args[0], possibly with
+          # lazily evaluated formatting arguments as in the standard logging API
+          msg = (args[0] % args[1:] if len(args) > 1 else args[0]) + ' '
           # now convert that to a dictionary assuming no `="` nor `" ` is present inside any key or value!
           # the added trailing space matches the `" ` split, so we remove the last element of that list
           msg = dict([tuple(kv.split('="')) for kv in msg.split('" ')[:-1]])
@@ -75,15 +93,15 @@ def logGeneralExceptionAndReturn(ex, req):
   '''Convenience function to log a stack trace and return HTTP 500'''
   ex_type, ex_value, ex_traceback = sys.exc_info()
   log.error('msg="Unexpected exception caught" exception="%s" type="%s" traceback="%s" client="%s" ' \
-            'requestedUrl="%s" token="%s"' % \
-            (ex, ex_type, traceback.format_exception(ex_type, ex_value, ex_traceback), req.remote_addr,
-             req.url, req.args['access_token'][-20:] if 'access_token' in req.args else 'N/A'))
+            'requestedUrl="%s" token="%s"', \
+            ex, ex_type, traceback.format_exception(ex_type, ex_value, ex_traceback), req.remote_addr,
+             req.url, req.args['access_token'][-20:] if 'access_token' in req.args else 'N/A')
   return 'Internal error, please contact support', http.client.INTERNAL_SERVER_ERROR
 
 
 def generateWopiSrc(fileid):
   '''Returns a valid URL-encoded WOPISrc for the given fileid'''
-  return url_quote_plus('%s/wopi/files/%s' % (wopi.wopiurl, fileid))
+  return wopi.wopisrcprefix + url_quote_plus(fileid)
 
 
 def getLibreOfficeLockName(filename):
@@ -116,20 +134,70 @@ def generateAccessToken(userid, fileid, viewmode, username, folderurl, endpoint)
     # the inode serves as fileid (and must not change across save operations), the mtime is used for version information.
     statInfo = st.statx(endpoint, fileid, userid, versioninv=1)
   except IOError as e:
-    log.info('msg="Requested file not found or not a file" fileid="%s" error="%s"' % (fileid, e))
+    log.info('msg="Requested file not found or not a file" fileid="%s" error="%s"', fileid, e)
     raise
   # if write access is requested, probe whether there's already a lock file coming from Desktop applications
   exptime = int(time.time()) + wopi.tokenvalidity
-  acctok = jwt.encode({'userid': userid, 'filename': statInfo['filepath'], 'username': username, 'viewmode': viewmode.value,
-                       'folderurl': folderurl, 'exp': exptime, 'endpoint': endpoint}, wopi.wopisecret, algorithm='HS256')
+  acctok = encodeJwt({'userid': userid, 'filename': statInfo['filepath'], 'username': username, 'viewmode': viewmode.value,
+                      'folderurl': folderurl, 'exp': exptime, 'endpoint': endpoint})
   log.info('msg="Access token generated" userid="%s" mode="%s" endpoint="%s" filename="%s" inode="%s" ' \
-           'mtime="%s" folderurl="%s" expiration="%d" token="%s"' % \
-           (userid, viewmode, endpoint, statInfo['filepath'], statInfo['inode'], statInfo['mtime'], \
-            folderurl, exptime, acctok[-20:]))
+           'mtime="%s" folderurl="%s" expiration="%d" token="%s"', \
+           userid, viewmode, endpoint, statInfo['filepath'], statInfo['inode'], statInfo['mtime'], \
+            folderurl, exptime, acctok[-20:])
   # return the inode == fileid and the access token
   return statInfo['inode'], acctok
 
 
+def _b64urlencode(data):
+  '''Base64url-encodes the given bytes without padding, as per RFC 7515'''
+  return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def encodeJwt(payload):
+  '''Signs the given payload as an HS256 JSON Web Token. This is equivalent to
+  jwt.encode(payload, wopi.wopisecret, algorithm='HS256'), but reuses the pre-encoded header'''
+  signinginput = JWTHEADER + b'.' + _b64urlencode(json.dumps(payload, separators=(',', ':')).encode())
+  return (signinginput + b'.' + _b64urlencode(hmac.new(wopi.wopisecret, signinginput, hashlib.sha256).digest())).decode()
+
+
+def _b64urldecode(data):
+  '''Base64url-decodes the given bytes, restoring the padding stripped as per RFC 7515'''
+  return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def decodeJwt(token):
+  '''Decodes and validates the given HS256 JSON Web Token, and returns its payload. The expiration time is checked
+  prior to verifying the signature, so that no HMAC is computed on expired tokens. Tokens whose header differs
+  from the one we issue are handed over to the generic jwt.decode().
+  Throws jwt.exceptions.DecodeError or ExpiredSignatureError in case of invalid or expired tokens'''
+  if isinstance(token, str):
+    token = token.encode()
+  try:
+    signinginput, signature = token.rsplit(b'.', 1)
+    header, payload = signinginput.split(b'.', 1)
+  except ValueError:
+    raise jwt.exceptions.DecodeError('Not enough segments')
+  if header != JWTHEADER:
+    return jwt.decode(token, wopi.wopisecret, algorithms=['HS256'])
+  try:
+    payload = json.loads(_b64urldecode(payload))
+    signature = _b64urldecode(signature)
+  except ValueError as e:
+    # this includes binascii.Error, UnicodeDecodeError and JSONDecodeError
+    raise jwt.exceptions.DecodeError('Invalid token: %s' % e)
+  if not isinstance(payload, dict):
+    raise jwt.exceptions.DecodeError('Invalid payload')
+  if 'exp' in payload:
+    # reject anything but a number (bool being an int subclass) before comparing it
+    if isinstance(payload['exp'], bool) or not isinstance(payload['exp'], (int, float)):
+      raise jwt.exceptions.DecodeError('Expiration Time claim (exp) must be an integer')
+    if payload['exp'] < time.time():
+      raise jwt.exceptions.ExpiredSignatureError('Signature has expired')
+  if not hmac.compare_digest(signature, hmac.new(wopi.wopisecret, signinginput, hashlib.sha256).digest()):
+    raise jwt.exceptions.InvalidSignatureError('Signature verification failed')
+  return payload
+
+
 def getLockName(filename):
   '''Generates a hidden filename used to store the WOPI locks'''
   if wopi.lockpath:
@@ -144,25 +212,26 @@ def retrieveWopiLock(fileid, operation, lock, acctok, overridefilename=None):
   '''Retrieves and logs an existing lock for a given file'''
   encacctok = flask.request.args['access_token'][-20:] if 'access_token' in flask.request.args else 'N/A'
   lockcontent = b''
-  for line in st.readfile(acctok['endpoint'], getLockName(overridefilename if overridefilename else acctok['filename']),
-                          acctok['userid']):
-    if isinstance(line, IOError):
-      return None     # no pre-existing lock found, or error attempting to read it: assume it does not exist
-    # the following check is necessary as it happens to get a str instead of bytes
-    lockcontent += line if isinstance(line, type(lockcontent)) else line.encode()
+  try:
+    for line in st.readfile(acctok['endpoint'], getLockName(overridefilename if overridefilename else acctok['filename']),
+                            acctok['userid']):
+      # the following check is necessary as it happens to get a str instead of bytes
+      lockcontent += line if isinstance(line, type(lockcontent)) else line.encode()
+  except IOError:
+    return None     # no pre-existing lock found, or error attempting to read it: assume it does not exist
   try:
     # check validity: a lock is deemed expired if the most recent between its expiration time and the last
     # save time by WOPI has passed
-    retrievedLock = jwt.decode(lockcontent, wopi.wopisecret, algorithms=['HS256'])
-    savetime = st.getxattr(acctok['endpoint'], acctok['filename'], acctok['userid'], LASTSAVETIMEKEY)
+    retrievedLock = decodeJwt(lockcontent)
+    savetime = st.getxattr(acctok['endpoint'], acctok['filename'], acctok['userid'], LASTSAVETIMEKEY, nocache=True)
     if max(0 if 'exp' not in retrievedLock else retrievedLock['exp'],
-           0 if savetime is None else int(savetime) + wopi.config.getint('general', 'wopilockexpiration')) < time.time():
+           0 if savetime is None else int(savetime) + wopi.wopilockexpiration) < time.time():
       # we got a malformed or expired lock, reject. Note that we may get an ExpiredSignatureError
-      # by jwt.decode() as we had stored it with a timed signature.
+      # by decodeJwt() as we had stored it with a timed signature.
       raise jwt.exceptions.ExpiredSignatureError
   except (jwt.exceptions.DecodeError, jwt.exceptions.ExpiredSignatureError) as e:
     log.warning('msg="%s" user="%s" filename="%s" token="%s" error="WOPI lock expired or invalid, ignoring" ' \
-                'exception="%s"' % (operation.title(), acctok['userid'], acctok['filename'], encacctok, type(e)))
+                'exception="%s"', operation.title(), acctok['userid'], acctok['filename'], encacctok, type(e))
     # the retrieved lock is not valid any longer, discard and remove it from the backend
     try:
       st.removefile(acctok['endpoint'], getLockName(acctok['filename']), acctok['userid'], 1)
@@ -172,36 +241,35 @@ def retrieveWopiLock(fileid, operation, lock, acctok, overridefilename=None):
     # also remove the LibreOffice-compatible lock file, if it has the expected signature - cf. storeWopiLock()
     try:
       lolock = next(st.readfile(acctok['endpoint'], getLibreOfficeLockName(acctok['filename']), acctok['userid']))
-      if isinstance(lolock, IOError):
-        raise lolock
       if 'WOPIServer' in lolock.decode('UTF-8'):
         st.removefile(acctok['endpoint'], getLibreOfficeLockName(acctok['filename']), acctok['userid'], 1)
     except (IOError, StopIteration) as e:
-      log.warning('msg="Unable to delete the LibreOffice-compatible lock file" error="%s"' % \
+      log.warning('msg="Unable to delete the LibreOffice-compatible lock file" error="%s"', \
                   ('empty lock' if isinstance(e, StopIteration) else str(e)))
     return None
-  log.info('msg="%s" user="%s" filename="%s" fileid="%s" lock="%s" retrievedLock="%s" expTime="%s" token="%s"' % \
-           (operation.title(), acctok['userid'], acctok['filename'], fileid, lock, retrievedLock['wopilock'],
-            time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(retrievedLock['exp'])), encacctok))
+  log.info('msg="%s" user="%s" filename="%s" fileid="%s" lock="%s" retrievedLock="%s" expTime="%s" token="%s"', \
+           operation.title(), acctok['userid'], acctok['filename'], fileid, lock, retrievedLock['wopilock'],
+            time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(retrievedLock['exp'])), encacctok)
   return retrievedLock['wopilock']
 
 
 def storeWopiLock(operation, lock, acctok, isnotoffice):
   '''Stores the lock for a given file in the form of an encoded JSON string (cf. the access token)'''
+  now = int(time.time())
   try:
     # validate that the underlying file is still there (it might have been moved/deleted)
     st.stat(acctok['endpoint'], acctok['filename'], acctok['userid'])
   except IOError as e:
-    log.warning('msg="%s: target file not found any longer" filename="%s" token="%s" reason="%s"' % \
-                (operation.title(), acctok['filename'], flask.request.args['access_token'][-20:], e))
+    log.warning('msg="%s: target file not found any longer" filename="%s" token="%s" reason="%s"', \
+                operation.title(), acctok['filename'], flask.request.args['access_token'][-20:], e)
     raise
 
   if not isnotoffice:
     try:
       # first try to look for a MS Office lock
       lockstat = st.stat(acctok['endpoint'], getMicrosoftOfficeLockName(acctok['filename']), acctok['userid'])
-      log.info('msg="WOPI lock denied because of an existing Microsoft Office lock" filename="%s" mtime="%ld"' % \
-               (acctok['filename'], lockstat['mtime']))
+      log.info('msg="WOPI lock denied because of an existing Microsoft Office lock" filename="%s" mtime="%ld"', \
+               acctok['filename'], lockstat['mtime'])
       raise IOError(EXCL_ERROR)
     except IOError as e:
       if EXCL_ERROR in str(e):
@@ -212,7 +280,7 @@ def storeWopiLock(operation, lock, acctok, isnotoffice):
       # then create a LibreOffice-compatible lock file for interoperability purposes, making sure to
       # not overwrite any existing or being created lock
       lockcontent = ',Collaborative Online Editor,%s,%s,WOPIServer;' % \
-                    (wopi.wopiurl, time.strftime('%d.%m.%Y %H:%M', time.localtime(time.time())))
+                    (wopi.wopiurl, time.strftime('%d.%m.%Y %H:%M', time.localtime(now)))
       st.writefile(acctok['endpoint'], getLibreOfficeLockName(acctok['filename']), acctok['userid'], \
                    lockcontent, islock=True)
     except IOError as e:
@@ -221,21 +289,19 @@ def storeWopiLock(operation, lock, acctok, isnotoffice):
         try:
           retrievedlock = next(st.readfile(acctok['endpoint'], \
                                            getLibreOfficeLockName(acctok['filename']), acctok['userid']))
-          if isinstance(retrievedlock, IOError):
-            raise retrievedlock
           retrievedlock = retrievedlock.decode('UTF-8')
         except (IOError, StopIteration) as e:
           retrievedlock = ''   # could not read the lock, maybe it's empty: still, deny WOPI lock
         if 'WOPIServer' not in retrievedlock:
           # the file was externally locked, make this call fail
-          log.info('msg="WOPI lock denied because of an existing LibreOffice lock" filename="%s" holder="%s"' % \
-                   (acctok['filename'], retrievedlock.split(',')[1] if ',' in retrievedlock else retrievedlock))
+          log.info('msg="WOPI lock denied because of an existing LibreOffice lock" filename="%s" holder="%s"', \
+                   acctok['filename'], retrievedlock.split(',')[1] if ',' in retrievedlock else retrievedlock)
           raise
         #else it's our previous lock: all right, move on
       else:
         # any other error is logged and raised
-        log.error('msg="%s: unable to store LibreOffice-compatible lock" filename="%s" token="%s" lock="%s" reason="%s"' % \
-                  (operation.title(), acctok['filename'], flask.request.args['access_token'][-20:], lock, e))
+        log.error('msg="%s: unable to store LibreOffice-compatible lock" filename="%s" token="%s" lock="%s" reason="%s"', \
+                  operation.title(), acctok['filename'], flask.request.args['access_token'][-20:], lock, e)
         raise
 
   try:
@@ -245,15 +311,15 @@ def storeWopiLock(operation, lock, acctok, isnotoffice):
     lockcontent = {}
     lockcontent['wopilock'] = lock
     # append or overwrite the expiration time
-    lockcontent['exp'] = int(time.time()) + wopi.config.getint('general', 'wopilockexpiration')
+    lockcontent['exp'] = now + wopi.wopilockexpiration
     st.writefile(acctok['endpoint'], getLockName(acctok['filename']), acctok['userid'], \
-                 jwt.encode(lockcontent, wopi.wopisecret, algorithm='HS256'))
-    log.info('msg="%s" filename="%s" token="%s" lock="%s" result="success"' % \
-             (operation.title(), acctok['filename'], flask.request.args['access_token'][-20:], lock))
+                 encodeJwt(lockcontent))
+    log.info('msg="%s" filename="%s" token="%s" lock="%s" result="success"', \
+             operation.title(), acctok['filename'], flask.request.args['access_token'][-20:], lock)
   except IOError as e:
     # any other error is logged and raised
-    log.error('msg="%s: unable to store WOPI lock" filename="%s" token="%s" lock="%s" reason="%s"' % \
-              (operation.title(), acctok['filename'], flask.request.args['access_token'][-20:], lock, e))
+    log.error('msg="%s: unable to store WOPI lock" filename="%s" token="%s" lock="%s" reason="%s"', \
+              operation.title(), acctok['filename'], flask.request.args['access_token'][-20:], lock, e)
     raise
 
 
@@ -263,7 +329,7 @@ def compareWopiLocks(lock1, lock2):
      a bug in Word Online, currently the internal format of the WOPI locks is looked at, based
      on heuristics. Note that this format is subject to change and is not documented!'''
   if lock1 == lock2:
-    log.debug('msg="compareLocks" lock1="%s" lock2="%s" result="True"' % (lock1, lock2))
+    log.debug('msg="compareLocks" lock1="%s" lock2="%s" result="True"', lock1, lock2)
     return True
   # XXX before giving up, attempt to parse the lock as a JSON dictionary
   try:
@@ -271,18 +337,18 @@ def compareWopiLocks(lock1, lock2):
     try:
       l2 = json.loads(lock2)
       if 'S' in l1 and 'S' in l2:
-        log.debug('msg="compareLocks" lock1="%s" lock2="%s" result="%r"' % (lock1, lock2, l1['S'] == l2['S']))
+        log.debug('msg="compareLocks" lock1="%s" lock2="%s" result="%r"', lock1, lock2, l1['S'] == l2['S'])
         return l1['S'] == l2['S']     # used by Word
-      log.debug('msg="compareLocks" lock1="%s" lock2="%s" result="False"' % (lock1, lock2))
+      log.debug('msg="compareLocks" lock1="%s" lock2="%s" result="False"', lock1, lock2)
       return False
     except (TypeError, ValueError):
       # lock2 is not a JSON dictionary
       if 'S' in l1:
-        log.debug('msg="compareLocks" lock1="%s" lock2="%s" result="%r"' % (lock1, lock2, l1['S'] == lock2))
+        log.debug('msg="compareLocks" lock1="%s" lock2="%s" result="%r"', lock1, lock2, l1['S'] == lock2)
         return l1['S'] == lock2          # also used by Word (BUG!)
   except (TypeError, ValueError):
     # lock1 is not a JSON dictionary: log the lock values and fail the comparison
-    log.debug('msg="compareLocks" lock1="%s" lock2="%s" result="False"' % (lock1, lock2))
+    log.debug('msg="compareLocks" lock1="%s" lock2="%s" result="False"', lock1, lock2)
     return False
 
 
@@ -293,17 +359,18 @@ def makeConflictResponse(operation, retrievedlock, lock, oldlock, filename, reas
   if reason:
     resp.headers['X-WOPI-LockFailureReason'] = resp.data = reason
   resp.status_code = http.client.CONFLICT
-  log.info('msg="%s" filename="%s" token="%s" lock="%s" oldLock="%s" retrievedLock="%s" %s' % \
-           (operation.title(), filename, flask.request.args['access_token'][-20:], \
-            lock, oldlock, retrievedlock, ('reason="%s"' % reason if reason else 'result="conflict"')))
+  log.info('msg="%s" filename="%s" token="%s" lock="%s" oldLock="%s" retrievedLock="%s" %s', \
+           operation.title(), filename, flask.request.args['access_token'][-20:], \
+            lock, oldlock, retrievedlock, ('reason="%s"' % reason if reason else 'result="conflict"'))
   return resp
 
 
 def storeWopiFile(request, acctok, xakey, targetname=''):
   '''Saves a file from an HTTP request to the given target filename (defaulting to the access token's one),
-     and stores the save time as an xattr. Throws IOError in case of any failure'''
+     and stores the save time as an xattr. Throws IOError in case of any failure.
+     The request body is streamed to the storage, so it must not have been consumed before.'''
   if not targetname:
     targetname = acctok['filename']
-  st.writefile(acctok['endpoint'], targetname, acctok['userid'], request.get_data())
+  st.writefile(acctok['endpoint'], targetname, acctok['userid'], request.stream)
   # save the current time for later conflict checking: this is never older than the mtime of the file
   st.setxattr(acctok['endpoint'], targetname, acctok['userid'], xakey, int(time.time()))
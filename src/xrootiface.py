@@ -8,34 +8,134 @@ Contributions: Michael.DSilva@aarnet.edu.au
 '''
 
 import time
-import os
+import threading
+import itertools
+import functools
+import re
+import tempfile
+from collections import deque
+from concurrent.futures import Future
 from stat import S_ISDIR
 from XRootD import client as XrdClient
 from XRootD.client.flags import OpenFlags, QueryCode, MkDirFlags, StatInfoFlags
 
 EOSVERSIONPREFIX = '.sys.v#.'
 
+# templates of the xroot URLs used for the EOS-specific commands and stat queries
+PROCURL = '%s//proc/user/%s&mgm.cmd=%s%s&%s'
+STATQUERY = '%s%s&mgm.pcmd=stat'
+
+# the return code of a failed opaque query, and
+# the fields of a stat record we use, according to https://gitlab.cern.ch/dss/eos/-/blob/master/mgm/XrdMgmOfs/fsctl/Stat.cc#L53:
+# inode, mode, uid, gid, size, mtime
+RETCODE = re.compile(rb'retc=(\d+)')
+STATRECORD = re.compile(rb'^\S+\s+\S+\s+(\S+)\s+(\d+)\s+\S+\s+(\S+)\s+(\S+)\s+\S+\s+(\d+)(?:\s+\S+){3}\s+(\d+)')
+
+# maximum number of files whose stat results are kept in the cache
+STATCACHESIZE = 10000
+
+# maximum number of asynchronous reads and writes in flight when reading or writing a file
+READWINDOW = 4
+WRITEWINDOW = 4
+
 # module-wide state
 config = None
 log = None
-xrdfs = {}    # this is to map each endpoint [string] to its XrdClient
+xrdfs = {}    # this is to map each endpoint [string] to a pool of XrdClients and the counter used to pick the next one
+xrdpoolsize = 1
+xrdlock = threading.Lock()
 defaultstorage = None
 homepath = None
+chunksize = None
+statcache = {}    # this is to map each (endpoint, filepath) to its recent stat and xattr results, see _getcachedstat()
+statgeneration = 0    # this is bumped on every invalidation of the statcache, see _cachestat()
+statcachettl = 0
+verfolderinodes = {}    # this is to map each (endpoint, version folder) to its inode and expiry time, see statx()
+verfoldercachettl = 0
+statcachelock = threading.Lock()
+inodeprefixes = {}    # this is to map each endpoint [string] to the prefix of its inodes, see _getinodeprefix()
 
 
 def _getxrdfor(endpoint):
-  '''Look up the xrootd client for the given endpoint, create it if missing.
-     Supports "default" for the defaultstorage endpoint.'''
-  global xrdfs           # pylint: disable=global-statement
-  global defaultstorage  # pylint: disable=global-statement
+  '''Look up an xrootd client for the given endpoint, create the pool of clients if missing.
+     Clients are handed out in a round-robin fashion, so that concurrent requests do not queue
+     behind a single one. Supports "default" for the defaultstorage endpoint.'''
   if endpoint == 'default':
-    return xrdfs[defaultstorage]
+    endpoint = defaultstorage
+  entry = xrdfs.get(endpoint)
+  if entry is None:
+    # not found, create it
+    with xrdlock:
+      entry = xrdfs.get(endpoint)
+      if entry is None:
+        entry = xrdfs[endpoint] = ([XrdClient.FileSystem(endpoint) for _ in range(xrdpoolsize)], itertools.count())
+  pool, counter = entry
+  return pool[next(counter) % len(pool)]
+
+
+def _getcachedstat(endpoint, filepath, key):
+  '''Look up a recent stat or xattr result for the given endpoint and filepath, where key identifies the kind
+     of operation and its arguments. Return None if missing or older than statcachettl.
+     Note that the cache is local to this process: changes made by other processes, other servers
+     or external clients are only seen once the entries expire, therefore callers that check for
+     conflicts must bypass it (cf. the nocache flag of stat, statx and getxattr).'''
   try:
-    return xrdfs[endpoint]
+    expiry, result = statcache[(_geturlfor(endpoint), filepath)][key]
   except KeyError:
-    # not found, create it
-    xrdfs[endpoint] = XrdClient.FileSystem(endpoint)
-    return xrdfs[endpoint]
+    return None
+  if expiry < time.monotonic():
+    return None
+  return result
+
+
+def _cachestat(endpoint, filepath, key, result, generation):
+  '''Store the given stat or xattr result in the cache, evicting the oldest file when the cache is full.
+     The generation is the value of statgeneration taken before the result was fetched: if any invalidation
+     happened in between, the result may predate it and it is not stored.'''
+  if statcachettl <= 0:
+    return
+  with statcachelock:
+    if generation != statgeneration:
+      return
+    if len(statcache) >= STATCACHESIZE:
+      # dicts preserve the insertion order, so this evicts the file cached first
+      statcache.pop(next(iter(statcache)))
+    statcache.setdefault((_geturlfor(endpoint), filepath), {})[key] = (time.monotonic() + statcachettl, result)
+
+
+def _invalidatestat(endpoint, filepath):
+  '''Drop any cached stat or xattr result for the given file, to be called on any operation that modifies it.
+     Return the new statgeneration.'''
+  global statgeneration   # pylint: disable=global-statement
+  with statcachelock:
+    statgeneration += 1
+    statcache.pop((_geturlfor(endpoint), filepath), None)
+    return statgeneration
+
+
+def _getverfolderpath(filepath):
+  '''Return the path of the EOS version folder of the given file, mapped into the target namespace'''
+  # EOS paths are always '/'-separated, so a single rpartition is enough to split them
+  dirname, _, basename = filepath.rpartition('/')
+  return _getfilepath(dirname + '/' + EOSVERSIONPREFIX + basename)
+
+
+def _invalidateverfolder(endpoint, filepath):
+  '''Drop the cached version folder inode of the given file, to be called when the file is moved or removed'''
+  global statgeneration   # pylint: disable=global-statement
+  with statcachelock:
+    statgeneration += 1
+    verfolderinodes.pop((_geturlfor(endpoint), _getverfolderpath(filepath)), None)
+
+
+def _getinodeprefix(endpoint):
+  '''Return the prefix of the inodes of the given endpoint: this is in the form `root://...` here, so we strip
+     the protocol and the domain. Note that "default" maps to an empty prefix, and that the result is part of
+     the fileids handed out to the clients, therefore it must not change.'''
+  prefix = inodeprefixes.get(endpoint)
+  if prefix is None:
+    prefix = inodeprefixes[endpoint] = endpoint[7:-8]
+  return prefix
 
 
 def _geturlfor(endpoint):
@@ -45,8 +145,10 @@ def _geturlfor(endpoint):
   return endpoint
 
 
-def _eosargs(userid, atomicwrite=0, bookingsize=0):
-  '''Assume userid is in the form uid:gid and split userid into uid,gid and generate extra EOS-specific arguments for the xroot URL'''
+@functools.lru_cache(maxsize=4096)
+def _eosuserargs(userid, atomicwrite):
+  '''Assume userid is in the form uid:gid and split userid into uid,gid and generate the EOS-specific user arguments
+     for the xroot URL. The result is memoized, as the userids come from a small population of active sessions.'''
   try:
     # try to assert that userid must follow a '%d:%d' format
     userid = userid.split(':')
@@ -54,37 +156,44 @@ def _eosargs(userid, atomicwrite=0, bookingsize=0):
       raise ValueError
     ruid = int(userid[0])
     rgid = int(userid[1])
-    return '?eos.ruid=%d&eos.rgid=%d' % (ruid, rgid) + '&eos.app=' + ('fuse::wopi' if not atomicwrite else 'wopi') + \
-            (('&eos.bookingsize='+str(bookingsize)) if bookingsize else '')
+    return '?eos.ruid=%d&eos.rgid=%d' % (ruid, rgid) + '&eos.app=' + ('fuse::wopi' if not atomicwrite else 'wopi')
   except (ValueError, IndexError):
     raise ValueError('Only Unix-based userid is supported with xrootd storage')
 
 
+def _eosargs(userid, atomicwrite=0, bookingsize=0):
+  '''Generate the extra EOS-specific arguments for the xroot URL, see _eosuserargs()'''
+  if bookingsize:
+    return _eosuserargs(userid, atomicwrite) + '&eos.bookingsize=' + str(bookingsize)
+  return _eosuserargs(userid, atomicwrite)
+
+
 def _xrootcmd(endpoint, cmd, subcmd, userid, args):
   '''Perform the <cmd>/<subcmd> action on the special /proc/user path on behalf of the given userid.
      Note that this is entirely EOS-specific.'''
   with XrdClient.File() as f:
-    url = _geturlfor(endpoint) + '//proc/user/' + _eosargs(userid) + '&mgm.cmd=' + cmd + \
-          ('&mgm.subcmd=' + subcmd if subcmd else '') + '&' + args
-    tstart = time.time()
+    url = PROCURL % (_geturlfor(endpoint), _eosargs(userid), cmd, '&mgm.subcmd=' + subcmd if subcmd else '', args)
+    tstart = time.monotonic_ns()
     rc, statInfo_unused = f.open(url, OpenFlags.READ)
-    tend = time.time()
-    log.info('msg="Invoked _xrootcmd" cmd="%s%s" url="%s" elapsedTimems="%.1f"' %
-             (cmd, ('/' + subcmd if subcmd else ''), url, (tend-tstart)*1000))
-    res = f.readline().decode('UTF-8').strip('\n').split('&')
+    tend = time.monotonic_ns()
+    log.info('msg="Invoked _xrootcmd" cmd="%s%s" url="%s" elapsedTimems="%.1f"', \
+             cmd, ('/' + subcmd if subcmd else ''), url, (tend-tstart)/1e6)
+    # the response is in the form mgm.proc.stdout=...&mgm.proc.stderr=...&mgm.proc.retc=...: split it from
+    # the right, so that any '&' in the stdout does not get in the way
+    res = f.readline().decode('UTF-8').strip('\n').rsplit('&', 2)
     if len(res) == 3:    # we may only just get stdout: in that case, assume it's all OK
-      rc = res[2]
-      rc = rc[rc.find('=')+1:]
+      rc = res[2].partition('=')[2]
       if rc != '0':
         # failure: get info from stderr, log and raise
-        msg = res[1][res[1].find('=')+1:]
-        log.info('msg="Error with xroot command" cmd="%s" subcmd="%s" args="%s" error="%s" rc="%s"' % \
-                 (cmd, subcmd, args, msg, rc.strip('\00')))
+        msg = res[1].partition('=')[2]
+        log.info('msg="Error with xroot command" cmd="%s" subcmd="%s" args="%s" error="%s" rc="%s"', \
+                 cmd, subcmd, args, msg, rc.strip('\00'))
         raise IOError(msg)
   # all right, return everything that came in stdout
-  return res[0][res[0].find('stdout=')+7:]
+  return res[0].partition('=')[2]
 
 
+@functools.lru_cache(maxsize=8192)
 def _getfilepath(filepath, encodeamp=False):
   '''Map the given filepath into the target namespace by prepending the homepath (see storagehomepath in wopiserver.conf)'''
   return homepath + (filepath if not encodeamp else filepath.replace('&', '#AND#'))     # this is a special legacy encoding by eos
@@ -96,180 +205,379 @@ def init(inconfig, inlog):
   global log            # pylint: disable=global-statement
   global defaultstorage # pylint: disable=global-statement
   global homepath       # pylint: disable=global-statement
+  global chunksize      # pylint: disable=global-statement
+  global statcachettl   # pylint: disable=global-statement
+  global xrdpoolsize    # pylint: disable=global-statement
+  global verfoldercachettl  # pylint: disable=global-statement
+  global xrdlock        # pylint: disable=global-statement
+  global statcachelock  # pylint: disable=global-statement
   config = inconfig
   log = inlog
+  chunksize = config.getint('io', 'chunksize')
+  statcachettl = config.getint('xroot', 'statcachettl', fallback=2)
+  verfoldercachettl = config.getint('xroot', 'verfoldercachettl', fallback=3600)
+  xrdpoolsize = max(1, config.getint('xroot', 'connpoolsize', fallback=4))
   defaultstorage = config.get('xroot', 'storageserver')
+  # drop any state inherited from a parent process, as init() is invoked again after a fork
+  xrdlock = threading.Lock()
+  statcachelock = threading.Lock()
+  xrdfs.clear()
+  statcache.clear()
+  verfolderinodes.clear()
+  inodeprefixes.clear()
   # prepare the xroot client for the default storageserver
   _getxrdfor(defaultstorage)
   if config.has_option('xroot', 'storagehomepath'):
     homepath = config.get('xroot', 'storagehomepath')
   else:
     homepath = ''
-
-
-def stat(endpoint, filepath, userid):
-  '''Stat a file via xroot on behalf of the given userid, and returns (size, mtime). Uses the default xroot API.'''
+  # the memoized paths depend on the homepath
+  _getfilepath.cache_clear()
+
+
+def stat(endpoint, filepath, userid, nocache=False):
+  '''Stat a file via xroot on behalf of the given userid, and returns (size, mtime). Uses the default xroot API.
+  With nocache=True, the storage is queried regardless of any cached result.'''
+  generation = statgeneration
+  statInfo = None if nocache else _getcachedstat(endpoint, filepath, ('stat', userid))
+  if statInfo:
+    return dict(statInfo)
+  origfilepath = filepath
   filepath = _getfilepath(filepath, encodeamp=True)
-  tstart = time.time()
+  tstart = time.monotonic_ns()
   rc, statInfo = _getxrdfor(endpoint).stat(filepath + _eosargs(userid))
-  tend = time.time()
-  log.info('msg="Invoked stat" filepath="%s" elapsedTimems="%.1f"' % (filepath, (tend-tstart)*1000))
+  tend = time.monotonic_ns()
+  log.info('msg="Invoked stat" filepath="%s" elapsedTimems="%.1f"', filepath, (tend-tstart)/1e6)
   if statInfo is None:
     raise IOError(rc.message.strip('\n'))
   if statInfo.flags & StatInfoFlags.IS_DIR > 0:
     raise IOError('Is a directory')
-  return {'size': statInfo.size, 'mtime': statInfo.modtime}
+  statInfo = {'size': statInfo.size, 'mtime': statInfo.modtime}
+  _cachestat(endpoint, origfilepath, ('stat', userid), dict(statInfo), generation)
+  return statInfo
 
 
-def statx(endpoint, filepath, userid, versioninv=0):
+def statx(endpoint, filepath, userid, versioninv=0, nocache=False):
   '''Get extended stat info (inode, filepath, userid, size, mtime) via an xroot opaque query on behalf of the given userid.
-  If versioninv=1, the logic to support the version folder is not triggered.'''
-  tstart = time.time()
-  rc, info = _getxrdfor(endpoint).query(QueryCode.OPAQUEFILE, _getfilepath(filepath, encodeamp=True) + _eosargs(userid) + '&mgm.pcmd=stat')
-  info = info.decode()
-  log.info('msg="Invoked stat" filepath="%s"' % _getfilepath(filepath))
-  if '[SUCCESS]' not in str(rc):
-    raise IOError(str(rc).strip('\n'))
-  if 'retc=2\\x00' in info:
-    raise IOError('No such file or directory')   # convert ENOENT
-  if 'retc=' in info:
-    raise IOError(info.strip('\n'))
-  statxdata = info.split()
-  # we got now a full record according to https://gitlab.cern.ch/dss/eos/-/blob/master/mgm/XrdMgmOfs/fsctl/Stat.cc#L53
-  if S_ISDIR(int(statxdata[3])):
+  If versioninv=0, the logic to support the version folder is not triggered and the file's own inode is returned:
+  callers that do not need a version-invariant inode should use it, as it saves the version folder lookup.
+  With nocache=True, the storage is queried regardless of any cached result.'''
+  generation = statgeneration
+  # the endpoint is part of the key as the inode is derived from it (e.g. "default" vs. its URL)
+  statInfo = None if nocache else _getcachedstat(endpoint, filepath, ('statx', endpoint, userid, versioninv))
+  if statInfo:
+    return dict(statInfo)
+  tstart = time.monotonic_ns()
+  rc, info = _getxrdfor(endpoint).query(QueryCode.OPAQUEFILE, STATQUERY % (_getfilepath(filepath, encodeamp=True), _eosargs(userid)))
+  log.info('msg="Invoked stat" filepath="%s"', _getfilepath(filepath))
+  if not rc.ok:
+    raise IOError(rc.message.strip('\n'))
+  retc = RETCODE.search(info)
+  if retc:
+    if retc.group(1) == b'2':
+      raise IOError('No such file or directory')   # convert ENOENT
+    raise IOError(info.decode().strip('\n'))
+  statxdata = STATRECORD.match(info)
+  if not statxdata:
+    raise IOError('Unexpected stat response: %s' % info.decode().strip('\n'))
+  # we got now a full record, of which we only extract the fields we need
+  fileinode, mode, uid, gid, size, mtime = statxdata.groups()
+  if S_ISDIR(int(mode)):
     raise IOError('Is a directory')      # EISDIR
+  fileinode = fileinode.decode()
   if versioninv == 0:
-    # classic statx info of the given file; endpoint is in the form `root://...` here, so we strip the protocol and the domain
-    return {'inode': endpoint[7:-8] + '.' + statxdata[2],
-            'filepath': filepath,
-            'userid': statxdata[5] + ':' + statxdata[6],
-            'size': int(statxdata[8]),
-            'mtime': int(statxdata[12])}
+    # classic statx info of the given file
+    statInfo = {'inode': _getinodeprefix(endpoint) + '.' + fileinode,
+                'filepath': filepath,
+                'userid': (uid + b':' + gid).decode(),
+                'size': int(size),
+                'mtime': int(mtime)}
+    _cachestat(endpoint, filepath, ('statx', endpoint, userid, versioninv), dict(statInfo), generation)
+    return statInfo
   # now stat the corresponding version folder to get an inode invariant to save operations, see CERNBOX-1216
-  verFolder = os.path.dirname(filepath) + os.path.sep + EOSVERSIONPREFIX + os.path.basename(filepath)
-  rcv, infov = _getxrdfor(endpoint).query(QueryCode.OPAQUEFILE, _getfilepath(verFolder) + _eosargs(userid) + '&mgm.pcmd=stat')
-  tend = time.time()
-  infov = infov.decode()
-  log.debug('msg="Invoked stat on version folder" endpoint="%s" filepath="%s" result="%s" elapsedTimems="%.1f"' % \
-            (endpoint, _getfilepath(verFolder), infov, (tend-tstart)*1000))
-  try:
-    if '[SUCCESS]' not in str(rcv) or 'retc=' in infov:
-      # the version folder does not exist: create it
-      # cf. https://github.com/cernbox/revaold/blob/master/api/public_link_manager_owncloud/public_link_manager_owncloud.go#L127
-      rcmkdir = _getxrdfor(endpoint).mkdir(_getfilepath(verFolder) + _eosargs(userid), MkDirFlags.MAKEPATH)
-      log.debug('msg="Invoked mkdir on version folder" filepath="%s" rc="%s"' % (_getfilepath(verFolder), rcmkdir))
-      if '[SUCCESS]' not in str(rcmkdir):
-        raise IOError
-      rcv, infov = _getxrdfor(endpoint).query(QueryCode.OPAQUEFILE, _getfilepath(verFolder) + _eosargs(userid) + '&mgm.pcmd=stat')
-      infov = infov.decode()
-      log.debug('msg="Invoked stat on version folder" filepath="%s" result="%s"' % (_getfilepath(verFolder), infov))
-      if '[SUCCESS]' not in str(rcv) or 'retc=' in infov:
+  verpath = _getverfolderpath(filepath)
+  # such inode does not change over the lifetime of the file, so we only need to fetch it once in a while
+  # (the folder may still be recreated behind our back, e.g. when the file is deleted and restored)
+  verinode = None
+  cached = verfolderinodes.get((_geturlfor(endpoint), verpath))
+  if cached and cached[0] > time.monotonic():
+    verinode = cached[1]
+  if verinode is None:
+    rcv, infov = _getxrdfor(endpoint).query(QueryCode.OPAQUEFILE, STATQUERY % (verpath, _eosargs(userid)))
+    tend = time.monotonic_ns()
+    log.debug('msg="Invoked stat on version folder" endpoint="%s" filepath="%s" result="%s" elapsedTimems="%.1f"', \
+              endpoint, verpath, infov, (tend-tstart)/1e6)
+    try:
+      if not rcv.ok or RETCODE.search(infov):
+        # the version folder does not exist: create it
+        # cf. https://github.com/cernbox/revaold/blob/master/api/public_link_manager_owncloud/public_link_manager_owncloud.go#L127
+        rcmkdir, _ = _getxrdfor(endpoint).mkdir(verpath + _eosargs(userid), MkDirFlags.MAKEPATH)
+        log.debug('msg="Invoked mkdir on version folder" filepath="%s" rc="%s"', verpath, rcmkdir)
+        if not rcmkdir.ok:
+          raise IOError
+        rcv, infov = _getxrdfor(endpoint).query(QueryCode.OPAQUEFILE, STATQUERY % (verpath, _eosargs(userid)))
+        log.debug('msg="Invoked stat on version folder" filepath="%s" result="%s"', verpath, infov)
+        if not rcv.ok or RETCODE.search(infov):
+          raise IOError
+      statxvdata = STATRECORD.match(infov)
+      if not statxvdata:
         raise IOError
-    statxvdata = infov.split()
-  except IOError:
-    log.warn('msg="Failed to mkdir/stat version folder" rc="%s"' % rcv)
-    statxvdata = statxdata
+      verinode = statxvdata.group(1).decode()
+      if verfoldercachettl > 0:
+        with statcachelock:
+          # as for _cachestat(), skip the caching if the version folder may have been invalidated meanwhile
+          if generation == statgeneration:
+            if len(verfolderinodes) >= STATCACHESIZE:
+              verfolderinodes.pop(next(iter(verfolderinodes)))
+            verfolderinodes[(_geturlfor(endpoint), verpath)] = (time.monotonic() + verfoldercachettl, verinode)
+    except IOError:
+      log.warning('msg="Failed to mkdir/stat version folder" rc="%s"', rcv)
+      verinode = fileinode
   # return the metadata of the given file, except for the inode that is taken from the version folder
-  log.debug('msg="Invoked stat return" fileid="%s" filepath="%s"' % \
-            (endpoint[7:-8] + '.' + statxvdata[2], _getfilepath(verFolder)))
-  return {'inode': endpoint[7:-8] + '.' + statxvdata[2],
-          'filepath': filepath,
-          'userid': statxdata[5] + ':' + statxdata[6],
-          'size': int(statxdata[8]),
-          'mtime': int(statxdata[12])}
+  inode = _getinodeprefix(endpoint) + '.' + verinode
+  log.debug('msg="Invoked stat return" fileid="%s" filepath="%s"', inode, verpath)
+  statInfo = {'inode': inode,
+              'filepath': filepath,
+              'userid': (uid + b':' + gid).decode(),
+              'size': int(size),
+              'mtime': int(mtime)}
+  _cachestat(endpoint, filepath, ('statx', endpoint, userid, versioninv), dict(statInfo), generation)
+  return statInfo
 
 
 def setxattr(endpoint, filepath, userid, key, value):
   '''Set the extended attribute <key> to <value> via a special open on behalf of the given userid'''
-  _xrootcmd(endpoint, 'attr', 'set', userid, 'mgm.attr.key=' + key + '&mgm.attr.value=' + str(value) + \
-            '&mgm.path=' + _getfilepath(filepath, encodeamp=True))
-
-
-def getxattr(endpoint, filepath, userid, key):
-  '''Get the extended attribute <key> via a special open on behalf of the given userid'''
+  try:
+    _xrootcmd(endpoint, 'attr', 'set', userid, 'mgm.attr.key=' + key + '&mgm.attr.value=' + str(value) + \
+              '&mgm.path=' + _getfilepath(filepath, encodeamp=True))
+  finally:
+    # even on failure, the attribute may have been changed
+    generation = _invalidatestat(endpoint, filepath)
+  # write-through the new value, as it is likely read back soon
+  _cachestat(endpoint, filepath, ('xattr', userid, key), str(value), generation)
+
+
+def getxattr(endpoint, filepath, userid, key, nocache=False):
+  '''Get the extended attribute <key> via a special open on behalf of the given userid.
+  With nocache=True, the storage is queried regardless of any cached result.'''
+  generation = statgeneration
+  value = None if nocache else _getcachedstat(endpoint, filepath, ('xattr', userid, key))
+  if value is not None:
+    return value
   res = _xrootcmd(endpoint, 'attr', 'get', userid, 'mgm.attr.key=' + key + '&mgm.path=' + _getfilepath(filepath, encodeamp=True))
   # if no error, the response comes in the format <key>="<value>"
   try:
-    return res.split('"')[1]
+    value = res.split('"')[1]
+    _cachestat(endpoint, filepath, ('xattr', userid, key), value, generation)
+    return value
   except IndexError:
-    log.warning('msg="Failed to getxattr" filepath="%s" key="%s" res="%s"' % (filepath, key, res))
+    log.warning('msg="Failed to getxattr" filepath="%s" key="%s" res="%s"', filepath, key, res)
     return None
 
 
 def rmxattr(endpoint, filepath, userid, key):
   '''Remove the extended attribute <key> via a special open on behalf of the given userid'''
-  _xrootcmd(endpoint, 'attr', 'rm', userid, 'mgm.attr.key=' + key + '&mgm.path=' + _getfilepath(filepath, encodeamp=True))
+  try:
+    _xrootcmd(endpoint, 'attr', 'rm', userid, 'mgm.attr.key=' + key + '&mgm.path=' + _getfilepath(filepath, encodeamp=True))
+  finally:
+    _invalidatestat(endpoint, filepath)
 
 
 def readfile(endpoint, filepath, userid):
-  '''Read a file via xroot on behalf of the given userid. Note that the function is a generator, managed by Flask.'''
-  log.debug('msg="Invoking readFile" filepath="%s"' % filepath)
-  with XrdClient.File() as f:
-    fileurl = _geturlfor(endpoint) + '/' + homepath + filepath + _eosargs(userid)
-    tstart = time.time()
-    rc, statInfo_unused = f.open(fileurl, OpenFlags.READ)
-    tend = time.time()
-    if not rc.ok:
-      # the file could not be opened: check the case of ENOENT and log it as info to keep the logs cleaner
-      if 'No such file or directory' in rc.message:
-        log.info('msg="File not found on read" filepath="%s"' % filepath)
-        yield IOError('No such file or directory')
-      else:
-        log.warning('msg="Error opening the file for read" filepath="%s" code="%d" error="%s"' % \
-                    (filepath, rc.shellcode, rc.message.strip('\n')))
-        yield IOError(rc.message)
-    else:
-      log.info('msg="File open for read" filepath="%s" elapsedTimems="%.1f"' % (filepath, (tend-tstart)*1000))
-      chunksize = config.getint('io', 'chunksize')
-      rc, statInfo = f.stat()
-      chunksize = min(chunksize, statInfo.size)
-      # the actual read is buffered and managed by the Flask server
-      for chunk in f.readchunks(offset=0, chunksize=chunksize):
+  '''Read a file via xroot on behalf of the given userid. The file is opened upfront and IOError is raised on failure,
+     otherwise a generator of the file's chunks is returned, managed by Flask.'''
+  log.debug('msg="Invoking readFile" filepath="%s"', filepath)
+  f = XrdClient.File()
+  fileurl = _geturlfor(endpoint) + '/' + homepath + filepath + _eosargs(userid)
+  tstart = time.monotonic_ns()
+  rc, _ = f.open(fileurl, OpenFlags.READ)
+  tend = time.monotonic_ns()
+  if not rc.ok:
+    # the file could not be opened: check the case of ENOENT and log it as info to keep the logs cleaner
+    if 'No such file or directory' in rc.message:
+      log.info('msg="File not found on read" filepath="%s"', filepath)
+      raise IOError('No such file or directory')
+    log.warning('msg="Error opening the file for read" filepath="%s" code="%d" error="%s"', \
+                filepath, rc.shellcode, rc.message.strip('\n'))
+    raise IOError(rc.message)
+  log.info('msg="File open for read" filepath="%s" elapsedTimems="%.1f"', filepath, (tend-tstart)/1e6)
+  # the size is needed to schedule the asynchronous reads
+  rc, statInfo = f.stat()
+  if not rc.ok:
+    log.warning('msg="Error stating the file for read" filepath="%s" error="%s"', filepath, rc.message.strip('\n'))
+    f.close()
+    raise IOError(rc.message.strip('\n'))
+  # the actual read is buffered and managed by the Flask server
+  return _readchunks(f, filepath, statInfo.size)
+
+
+def _readchunks(f, filepath, size):
+  '''Read the given size from the open file f in chunks, keeping up to READWINDOW asynchronous reads in flight.
+     This is a generator yielding the chunks in order, which closes the file at the end and raises IOError
+     in case of failure.'''
+  with f:
+    pending = deque()
+    offset = 0
+    try:
+      while offset < size or pending:
+        # prefetch the next chunks, so that their round trips overlap with the current one
+        while offset < size and len(pending) < READWINDOW:
+          length = min(chunksize, size - offset)
+          future = Future()
+          def _done(status, response, _hostlist, future=future):
+            '''Callback of the asynchronous read'''
+            if status.ok:
+              future.set_result(response)
+            else:
+              future.set_exception(IOError(status.message.strip('\n')))
+          rc = f.read(offset=offset, size=length, callback=_done)
+          if not rc.ok:
+            # the request was not even submitted
+            future.set_exception(IOError(rc.message.strip('\n')))
+          pending.append(future)
+          offset += length
+        try:
+          chunk = pending.popleft().result()
+        except IOError as e:
+          log.warning('msg="Error reading the file" filepath="%s" error="%s"', filepath, e)
+          raise
         yield chunk
+    finally:
+      # make sure no read is in flight when the file gets closed, e.g. if the client went away
+      for future in pending:
+        future.exception()
+
+
+def _writechunks(f, chunks):
+  '''Write the given chunks in sequence to the open file f, keeping up to WRITEWINDOW asynchronous writes
+     in flight, and return the written size. On any failure, including while fetching the chunks, the pending
+     writes are waited for, f is closed and IOError is raised.'''
+  window = threading.BoundedSemaphore(WRITEWINDOW)
+  failed = []
+  offset = 0
+  try:
+    for chunk in chunks:
+      window.acquire()
+      if failed:
+        window.release()
+        break
+      def _done(status, _response, _hostlist, _chunk=chunk):
+        '''Callback of the asynchronous write, which also keeps a reference to the chunk until written'''
+        if not status.ok:
+          failed.append(status.message.strip('\n'))
+        window.release()
+      try:
+        rc = f.write(chunk, offset=offset, size=len(chunk), callback=_done)
+      except Exception:
+        window.release()
+        raise
+      if not rc.ok:
+        # the request was not even submitted
+        failed.append(rc.message.strip('\n'))
+        window.release()
+        break
+      offset += len(chunk)
+  except Exception as e:     # pylint: disable=broad-except
+    failed.append(str(e))
+  # wait for all pending writes to complete
+  for _ in range(WRITEWINDOW):
+    window.acquire()
+  if failed:
+    f.close()
+    raise IOError(failed[0])
+  return offset
+
+
+def _spoolstream(content):
+  '''Receive the whole content of the given file-like object into a temporary file, kept in memory up to
+     the configured chunksize and on local disk beyond, and return it rewound together with its size.
+     IOError is raised if the stream fails midway.'''
+  spool = tempfile.SpooledTemporaryFile(max_size=chunksize)
+  try:
+    for chunk in iter(lambda: content.read(chunksize), b''):
+      spool.write(chunk)
+  except Exception as e:     # pylint: disable=broad-except
+    spool.close()
+    raise IOError(e)
+  size = spool.tell()
+  spool.seek(0)
+  return spool, size
 
 
 def writefile(endpoint, filepath, userid, content, islock=False):
   '''Write a file via xroot on behalf of the given userid. The entire content is written
      and any pre-existing file is deleted (or moved to the previous version if supported).
+     The content may be either a bytes/str buffer or a file-like object, which is then streamed.
      With islock=True, the write explicitly disables versioning, and the file is opened with
      O_CREAT|O_EXCL, preventing race conditions.'''
-  size = len(content)
-  log.debug('msg="Invoking writeFile" filepath="%s" userid="%s" size="%d" islock="%s"' % (filepath, userid, size, islock))
+  # drop any cached stat of this file, now and once the storage was touched, whatever the outcome (see below)
+  _invalidatestat(endpoint, filepath)
+  isstream = hasattr(content, 'read')
+  if isinstance(content, str):
+    content = content.encode()
+  if isstream:
+    # the stream is fully received before the target is touched, so that an aborted upload does not truncate it:
+    # EOS refuses to rename over an existing file, hence the content is spooled locally and not on the storage
+    try:
+      content, size = _spoolstream(content)
+    except IOError as e:
+      log.warning('msg="Error receiving the content to write" filepath="%s" error="%s"', filepath, e)
+      raise
+  else:
+    size = len(content)
+  try:
+    _writecontent(endpoint, filepath, userid, content, size, islock)
+  finally:
+    _invalidatestat(endpoint, filepath)
+    if isstream:
+      content.close()
+
+
+def _writecontent(endpoint, filepath, userid, content, size, islock):
+  '''Write the given content of the given size (either a bytes buffer or a file-like object) via xroot.'''
+  log.debug('msg="Invoking writeFile" filepath="%s" userid="%s" size="%d" islock="%s"', filepath, userid, size, islock)
   f = XrdClient.File()
-  tstart = time.time()
+  tstart = time.monotonic_ns()
   rc, statInfo_unused = f.open(_geturlfor(endpoint) + '/' + homepath + filepath + _eosargs(userid, not islock, size),
                                OpenFlags.NEW if islock else OpenFlags.DELETE)
-  tend = time.time()
+  tend = time.monotonic_ns()
   if not rc.ok:
     if islock and 'File exists' in rc.message:
       # racing against an existing file
-      log.info('msg="File exists on write but islock flag requested" filepath="%s"' % filepath)
+      log.info('msg="File exists on write but islock flag requested" filepath="%s"', filepath)
       raise IOError('File exists and islock flag requested')
     # any other failure is reported as is
-    log.warning('msg="Error opening the file for write" filepath="%s" error="%s"' % (filepath, rc.message.strip('\n')))
+    log.warning('msg="Error opening the file for write" filepath="%s" error="%s"', filepath, rc.message.strip('\n'))
     raise IOError(rc.message.strip('\n'))
   # write the file. In a future implementation, we should find a way to only update the required chunks...
-  rc, statInfo_unused = f.write(content, offset=0, size=size)
-  if not rc.ok:
-    log.warning('msg="Error writing the file" filepath="%s" error="%s"' % (filepath, rc.message.strip('\n')))
-    raise IOError(rc.message.strip('\n'))
-  rc, statInfo_unused = f.truncate(size)
-  if not rc.ok:
-    log.warning('msg="Error truncating the file" filepath="%s" error="%s"' % (filepath, rc.message.strip('\n')))
-    raise IOError(rc.message.strip('\n'))
+  if hasattr(content, 'read'):
+    chunks = iter(lambda: content.read(chunksize), b'')
+  else:
+    chunks = (content[offset:offset+chunksize] for offset in range(0, size, chunksize))
+  try:
+    _writechunks(f, chunks)
+  except IOError as e:
+    log.warning('msg="Error writing the file" filepath="%s" error="%s"', filepath, e)
+    raise
   rc, statInfo_unused = f.close()
   if not rc.ok:
-    log.warning('msg="Error closing the file" filepath="%s" error="%s"' % (filepath, rc.message.strip('\n')))
+    log.warning('msg="Error closing the file" filepath="%s" error="%s"', filepath, rc.message.strip('\n'))
     raise IOError(rc.message.strip('\n'))
-  log.info('msg="File written successfully" filepath="%s" elapsedTimems="%.1f" islock="%s"' % \
-           (filepath, (tend-tstart)*1000, islock))
+  log.info('msg="File written successfully" filepath="%s" elapsedTimems="%.1f" islock="%s"', \
+           filepath, (tend-tstart)/1e6, islock)
 
 
 def renamefile(endpoint, origfilepath, newfilepath, userid):
   '''Rename a file via a special open from origfilepath to newfilepath on behalf of the given userid.'''
-  _xrootcmd(endpoint, 'file', 'rename', userid, 'mgm.path=' + _getfilepath(origfilepath, encodeamp=True) + \
-            '&mgm.file.source=' + _getfilepath(origfilepath, encodeamp=True) + \
-            '&mgm.file.target=' + _getfilepath(newfilepath, encodeamp=True))
+  try:
+    _xrootcmd(endpoint, 'file', 'rename', userid, 'mgm.path=' + _getfilepath(origfilepath, encodeamp=True) + \
+              '&mgm.file.source=' + _getfilepath(origfilepath, encodeamp=True) + \
+              '&mgm.file.target=' + _getfilepath(newfilepath, encodeamp=True))
+  finally:
+    _invalidatestat(endpoint, origfilepath)
+    _invalidatestat(endpoint, newfilepath)
+    _invalidateverfolder(endpoint, origfilepath)
+    _invalidateverfolder(endpoint, newfilepath)
 
 
 def removefile(endpoint, filepath, userid, force=0):
@@ -278,5 +586,9 @@ def removefile(endpoint, filepath, userid, force=0):
      This is useful for lock files, but as it requires root access the userid is overridden.'''
   if force:
     userid = '0:0'
-  _xrootcmd(endpoint, 'rm', None, userid, 'mgm.path=' + _getfilepath(filepath, encodeamp=True) + \
-                                          ('&mgm.option=f' if force else ''))
+  try:
+    _xrootcmd(endpoint, 'rm', None, userid, 'mgm.path=' + _getfilepath(filepath, encodeamp=True) + \
+                                            ('&mgm.option=f' if force else ''))
+  finally:
+    _invalidatestat(endpoint, filepath)
+    _invalidateverfolder(endpoint, filepath)
@@ -11,6 +11,8 @@ import logging
 import configparser
 import sys
 import os
+import uuid
+from io import BytesIO
 from threading import Thread
 sys.path.append('../src')  # for tests out of the git repo
 sys.path.append('/app')    # for tests within the Docker image
@@ -96,6 +98,17 @@ class TestStorage(unittest.TestCase):
     self.assertEqual(statInfo['inode'], inode, 'Fileid is not invariant to multiple write operations')
     self.storage.removefile(self.endpoint, self.homepath + '/test.txt', self.userid)
 
+  def test_statx_invariant_fileid_newfile(self):
+    '''Call statx() on a brand new file, whose version folder (if any) does not exist yet and gets created'''
+    filepath = self.homepath + '/test_%s.txt' % uuid.uuid4().hex
+    self.storage.writefile(self.endpoint, filepath, self.userid, b'bla\n')
+    statInfo = self.storage.statx(self.endpoint, filepath, self.userid, versioninv=1)
+    self.assertIsInstance(statInfo, dict)
+    self.assertEqual(statInfo['filepath'], filepath)
+    # the second call goes through the existing version folder
+    self.assertEqual(self.storage.statx(self.endpoint, filepath, self.userid, versioninv=1)['inode'], statInfo['inode'])
+    self.storage.removefile(self.endpoint, filepath, self.userid)
+
   def test_stat_nofile(self):
     '''Call stat() and assert the exception is as expected'''
     with self.assertRaises(IOError) as context:
@@ -140,11 +153,53 @@ class TestStorage(unittest.TestCase):
     self.assertEqual(content, '', 'File test.txt should be empty')
     self.storage.removefile(self.endpoint, self.homepath + '/test.txt', self.userid)
 
+  def test_write_stream(self):
+    '''Writes a file from a file-like object and reads it back, validating that the content matches'''
+    content = b'bla' * 1000
+    self.storage.writefile(self.endpoint, self.homepath + '/test.txt', self.userid, BytesIO(content))
+    readcontent = b''
+    for chunk in self.storage.readfile(self.endpoint, self.homepath + '/test.txt', self.userid):
+      self.assertNotIsInstance(chunk, IOError, 'raised by storage.readfile')
+      readcontent += chunk
+    self.assertEqual(readcontent, content, 'File test.txt should contain the streamed content')
+    self.storage.removefile(self.endpoint, self.homepath + '/test.txt', self.userid)
+
+  def test_write_stream_keeps_fileid(self):
+    '''Streams a file over an existing one, validating that its fileid and xattrs are preserved'''
+    self.storage.writefile(self.endpoint, self.homepath + '/test.txt', self.userid, b'original content')
+    self.storage.setxattr(self.endpoint, self.homepath + '/test.txt', self.userid, 'testkey', 123)
+    inode = self.storage.statx(self.endpoint, self.homepath + '/test.txt', self.userid, versioninv=1)['inode']
+    self.storage.writefile(self.endpoint, self.homepath + '/test.txt', self.userid, BytesIO(b'new' * 1000))
+    statInfo = self.storage.statx(self.endpoint, self.homepath + '/test.txt', self.userid, versioninv=1)
+    self.assertEqual(statInfo['inode'], inode, 'Fileid is not invariant to streamed write operations')
+    self.assertEqual(statInfo['size'], 3000)
+    v = self.storage.getxattr(self.endpoint, self.homepath + '/test.txt', self.userid, 'testkey')
+    self.assertEqual(v, '123', 'Xattrs are not preserved by streamed write operations')
+    self.storage.removefile(self.endpoint, self.homepath + '/test.txt', self.userid)
+
+  def test_write_stream_interrupted(self):
+    '''Streams a file from a file-like object failing midway, validating that the pre-existing content is left untouched'''
+    class FailingStream(BytesIO):
+      '''A stream that fails after returning its first chunk, as for a client disconnecting during an upload'''
+      def read(self, size=-1):
+        if self.tell() > 0:
+          raise ConnectionError('Client disconnected')
+        return super().read(min(size, 10) if size > 0 else 10)
+    content = b'original content'
+    self.storage.writefile(self.endpoint, self.homepath + '/test.txt', self.userid, content)
+    with self.assertRaises(IOError):
+      self.storage.writefile(self.endpoint, self.homepath + '/test.txt', self.userid, FailingStream(b'new' * 1000))
+    readcontent = b''
+    for chunk in self.storage.readfile(self.endpoint, self.homepath + '/test.txt', self.userid):
+      readcontent += chunk
+    self.assertEqual(readcontent, content, 'File test.txt should still contain the original content')
+    self.storage.removefile(self.endpoint, self.homepath + '/test.txt', self.userid)
+
   def test_read_nofile(self):
     '''Test reading of a non-existing file'''
-    readex = next(self.storage.readfile(self.endpoint, self.homepath + '/hopefullynotexisting', self.userid))
-    self.assertIsInstance(readex, IOError, 'readfile returned %s' % readex)
-    self.assertEqual(str(readex), 'No such file or directory', 'readfile returned %s' % readex)
+    with self.assertRaises(IOError) as context:
+      self.storage.readfile(self.endpoint, self.homepath + '/hopefullynotexisting', self.userid)
+    self.assertEqual(str(context.exception), 'No such file or directory')
 
   def test_write_remove_specialchars(self):
     '''Test write and removal of a file with special chars'''
@@ -204,6 +259,16 @@ class TestStorage(unittest.TestCase):
     self.assertEqual(v, None)
     self.storage.removefile(self.endpoint, self.homepath + '/test&xattr.txt', self.userid)
 
+  def test_nocache(self):
+    '''Test that stat and getxattr bypassing any cache return the current metadata'''
+    self.storage.writefile(self.endpoint, self.homepath + '/test.txt', self.userid, b'bla\n')
+    self.storage.setxattr(self.endpoint, self.homepath + '/test.txt', self.userid, 'testkey', 123)
+    statInfo = self.storage.stat(self.endpoint, self.homepath + '/test.txt', self.userid)
+    self.assertEqual(self.storage.stat(self.endpoint, self.homepath + '/test.txt', self.userid, nocache=True), statInfo)
+    v = self.storage.getxattr(self.endpoint, self.homepath + '/test.txt', self.userid, 'testkey', nocache=True)
+    self.assertEqual(v, '123')
+    self.storage.removefile(self.endpoint, self.homepath + '/test.txt', self.userid)
+
   def test_rename_statx(self):
     '''Test renaming and statx of a file with special chars'''
     buf = b'bla\n'
@@ -0,0 +1,94 @@
+'''
+test_wopiutils.py
+
+Basic unit testing of the JSON Web Token helpers of the WOPI server. The tests are skipped
+if the server dependencies (flask and jwt, see /requirements.txt) are not available.
+'''
+
+import unittest
+import sys
+import time
+import base64
+import json
+import hmac
+import hashlib
+from types import SimpleNamespace
+from unittest import mock
+sys.path.append('../src')  # for tests out of the git repo
+sys.path.append('/app')    # for tests within the Docker image
+try:
+  import jwt
+  import wopiutils
+except ImportError:
+  wopiutils = None
+
+
+def _b64(data):
+  '''Base64url-encodes the given bytes without padding'''
+  return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+@unittest.skipIf(wopiutils is None, 'flask and jwt are required to test wopiutils')
+class TestJwt(unittest.TestCase):
+  '''Tests for the HS256 JSON Web Token encoding and decoding'''
+
+  def setUp(self):
+    '''Provide the secret the helpers expect from the Wopi class'''
+    self.secret = b'wopiserver-test-secret-of-at-least-32-bytes'
+    wopiutils.wopi = SimpleNamespace(wopisecret=self.secret)
+    self.payload = {'userid': 'testuser', 'filename': '/test.txt', 'exp': int(time.time()) + 3600}
+
+  def _sign(self, header, payload):
+    '''Build a token with the given raw header and payload, signed with the test secret'''
+    signinginput = _b64(header) + b'.' + _b64(payload)
+    return (signinginput + b'.' + _b64(hmac.new(self.secret, signinginput, hashlib.sha256).digest())).decode()
+
+  def test_roundtrip(self):
+    '''Tokens are interoperable with the jwt library in both directions'''
+    self.assertEqual(jwt.decode(wopiutils.encodeJwt(self.payload), self.secret, algorithms=['HS256']), self.payload)
+    self.assertEqual(wopiutils.decodeJwt(jwt.encode(self.payload, self.secret, algorithm='HS256')), self.payload)
+    self.assertEqual(wopiutils.decodeJwt(wopiutils.encodeJwt(self.payload)), self.payload)
+
+  def test_tampered_signature(self):
+    '''A token whose payload was changed after signing is rejected'''
+    header, _payload, signature = wopiutils.encodeJwt(self.payload).split('.')
+    forged = dict(self.payload, userid='attacker')
+    token = header + '.' + _b64(json.dumps(forged).encode()).decode() + '.' + signature
+    with self.assertRaises(jwt.exceptions.InvalidSignatureError):
+      wopiutils.decodeJwt(token)
+
+  def test_foreign_header(self):
+    '''A token with a header different from ours is handed over to jwt.decode'''
+    token = self._sign(b'{"typ":"JWT","alg":"HS256"}', json.dumps(self.payload).encode())
+    with mock.patch.object(wopiutils.jwt, 'decode', wraps=jwt.decode) as decode:
+      self.assertEqual(wopiutils.decodeJwt(token), self.payload)
+      decode.assert_called_once()
+
+  def test_expired(self):
+    '''An expired token is rejected'''
+    token = wopiutils.encodeJwt(dict(self.payload, exp=int(time.time()) - 10))
+    with self.assertRaises(jwt.exceptions.ExpiredSignatureError):
+      wopiutils.decodeJwt(token)
+
+  def test_nonnumeric_exp(self):
+    '''A token with a non-numeric expiration time is rejected'''
+    for exp in ['1234', True, None, [1234]]:
+      token = wopiutils.encodeJwt(dict(self.payload, exp=exp))
+      with self.assertRaises(jwt.exceptions.DecodeError):
+        wopiutils.decodeJwt(token)
+
+  def test_malformed(self):
+    '''Tokens with missing or undecodable segments are rejected'''
+    header = wopiutils.JWTHEADER.decode()
+    for token in ['', 'abc', header + '.abc', header + '.!!!.abc', header + '.' + _b64(b'[1, 2]').decode() + '.abc']:
+      with self.assertRaises(jwt.exceptions.DecodeError):
+        wopiutils.decodeJwt(token)
+
+  def test_legacy_lock(self):
+    '''A lock written by the former jwt.encode()-based encoder is still decoded'''
+    lock = {'doc': '/test.txt', 'wopilock': 'testlock'}
+    self.assertEqual(wopiutils.decodeJwt(jwt.encode(lock, self.secret, algorithm='HS256')), lock)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -80,9 +80,8 @@ try:
     wopiTime = storage.getxattr(instance, filename, '0:0', 'oc.wopi.lastwritetime')
     try:
       lockcontent = b''
+      # readfile raises IOError if no pre-existing lock is found or it cannot be read: assume it does not exist
       for line in storage.readfile(instance, _getLockName(filename), '0:0'):
-        if isinstance(line, IOError):
-          raise line     # no pre-existing lock found, or error attempting to read it: assume it does not exist
         # the following check is necessary as it happens to get a str instead of bytes
         lockcontent += line if isinstance(line, type(lockcontent)) else line.encode()
       wopiLock = jwt.decode(lockcontent, wopisecret, algorithms=['HS256'])